@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
 from retraktarr import main
 
-main()
+# spawned worker processes import this as __mp_main__, they mustn't run the cli
+if __name__ == "__main__":
+    main()
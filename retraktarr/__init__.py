@@ -1 +1,11 @@
+from .engine import SyncEngine
+from .exceptions import (
+    ArrError,
+    ConfigurationError,
+    ListLimitError,
+    RetraktarrError,
+    TraktAuthError,
+    TraktError,
+)
+from .models import ListItem, RestoreResult, SyncJob, SyncResult
 from .retraktarr import main
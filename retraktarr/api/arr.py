@@ -1,113 +1,248 @@
 #!/usr/bin/env python3
 """ handles the arr api calls and requests """
-import sys
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import requests
 
+from retraktarr.api.arrdb import ArrDatabase
+from retraktarr.exceptions import ArrError
+from retraktarr.parallel import (
+    MIN_POOL_BYTES,
+    WorkerPool,
+    library_row,
+    parse_library,
+)
+from retraktarr.spill import CHUNK_SIZE, SpillMap, iter_array, spill_limit
+from retraktarr.timeouts import TimeoutModel
+
+logger = logging.getLogger(__name__)
+
 
 class ArrAPI:
     """arr api handler class"""
 
-    def __init__(self):
-        self.api_url = ""
-        self.api_key = ""
+    def __init__(self, api_url="", api_key="", database=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        # the arr's sqlite database, read instead of the library endpoint when set
+        self.database = ArrDatabase(database) if database else None
+        self.arr_session = requests.Session()
+        # jobs for several trakt accounts can share one arr instance
+        self.lock = threading.Lock()
+        # decodes big libraries in worker processes (SyncEngine shares its pool)
+        self.workers = WorkerPool()
+        # learned response times, every request's timeouts come from them
+        # (SyncEngine shares its model, which is kept between runs)
+        self.timeouts = TimeoutModel()
+        # bytes the library may take up (--max-memory), it's streamed in and
+        # moved to a temporary on-disk store past that. None keeps it all in memory
+        self.max_memory = None
         self.endpoint = {
             "Sonarr": ("series", "tvdb", "shows"),
             "Radarr": ("movie", "tmdb", "movies"),
         }
 
-    # queries arr and gets the return from the end point passed to it
-    def arr_get(self, arr, endpoint, timeout):
-        """sends the get request to the arr endpoint"""
-        try:
-            parsed_url = urlparse(self.api_url)
+    def request_url(self):
+        """returns the api url (without credentials) and basic auth, if any"""
+        parsed_url = urlparse(self.api_url)
 
-            url_host = parsed_url._replace(
-                netloc=parsed_url.netloc.split("@")[-1]
-            ).netloc
+        url_host = parsed_url._replace(netloc=parsed_url.netloc.split("@")[-1]).netloc
 
-            url_path = parsed_url.path if parsed_url.path is not None else ""
+        url_path = parsed_url.path if parsed_url.path is not None else ""
 
-            request_url = f"{parsed_url.scheme}://{url_host}{url_path}"
+        request_url = f"{parsed_url.scheme}://{url_host}{url_path}"
 
-            if (parsed_url.username is None) or (parsed_url.password is None):
-                response = requests.get(
-                    f"{request_url}/api/v3/{endpoint}",
-                    params={"apikey": self.api_key},
-                    timeout=timeout,
-                )
-            else:
-                response = requests.get(
-                    f"{request_url}/api/v3/{endpoint}",
-                    params={"apikey": self.api_key},
-                    timeout=timeout,
-                    auth=(parsed_url.username, parsed_url.password),
-                )
+        if (parsed_url.username is None) or (parsed_url.password is None):
+            return request_url, None
+        return request_url, (parsed_url.username, parsed_url.password)
+
+    @staticmethod
+    def arr_error(arr, error):
+        """turns a requests exception into an ArrError"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return ArrError(f"{arr}: Connection Timed Out. Check your URL.")
+        if isinstance(error, requests.exceptions.ConnectionError):
+            reason = str(error).split("] ")[-1].split("'")[0]
+            return ArrError(
+                f"{arr}: Connection Error. Check Your URL or server.\n{arr}: {reason}"
+            )
+        if "401" in str(error):
+            return ArrError(
+                f"{arr} Error: API key incorrect. "
+                "Please double check your key and config file."
+            )
+        return ArrError(f"{arr} Error:\n{arr}: {error}")
+
+    # queries arr and gets the return from the end point passed to it
+    def arr_get(self, arr, endpoint, items=0, stream=False):
+        """
+        sends the get request to the arr endpoint, items is how many items it's
+        expected to list for its timeout (None for the library: as many as it
+        listed last time). a streamed response's body is left to the caller
+        """
+        with self.lock:
+            request_url, auth = self.request_url()
+            url = f"{request_url}/api/v3/{endpoint}"
+            # whole libraries are learned apart from the small endpoints
+            kind = self.timeouts.kind("GET", url, "library" if items is None else None)
+            cold = 10
+            if items is None:
+                items = self.timeouts.expected_items(url)
+                cold = 60
+            # a stalled response gets one more try, with twice the time
+            for attempt in range(2):
+                timeout = self.timeouts.timeout(kind, items, cold=cold)
+                try:
+                    started = time.perf_counter()
+                    response = self.arr_session.get(
+                        url,
+                        params={"apikey": self.api_key},
+                        timeout=timeout,
+                        auth=auth,
+                        stream=stream,
+                    )
+                    response.raise_for_status()
+                    self.timeouts.observe(
+                        kind,
+                        items,
+                        response,
+                        time.perf_counter() - started,
+                        received=0 if stream else None,
+                    )
+                    return response
+                except requests.exceptions.ReadTimeout as error:
+                    self.timeouts.stalled(kind, timeout[1])
+                    if attempt:
+                        raise self.arr_error(arr, error) from error
+                except (
+                    requests.exceptions.ConnectTimeout,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.HTTPError,
+                ) as error:
+                    raise self.arr_error(arr, error) from error
+
+    def arr_post(self, arr, endpoint, body, items=0, label=None):
+        """
+        sends a post request to the arr endpoint (not serialized by the
+        lock, restores post several import batches at once). items is how
+        many items it sends, label keeps the timeouts of costly kinds of
+        posts (imports) apart
+        """
+        request_url, auth = self.request_url()
+        url = f"{request_url}/api/v3/{endpoint}"
+        kind = self.timeouts.kind("POST", url, label)
+        timeout = self.timeouts.timeout(kind, items, cold=120 if items else 10)
+        try:
+            started = time.perf_counter()
+            response = self.arr_session.post(
+                url,
+                params={"apikey": self.api_key},
+                json=body,
+                timeout=timeout,
+                auth=auth,
+            )
             response.raise_for_status()
+            self.timeouts.observe(kind, items, response, time.perf_counter() - started)
             return response
-        except requests.exceptions.ConnectTimeout:
-            print(f"{arr}: Connection Timed Out. Check your URL.")
-            sys.exit(1)
-        except requests.exceptions.ConnectionError as error:
-            print(f"{arr}: Connection Error. Check Your URL or server.")
-            error = str(error).split("] ")[1].split("'")[0]
-            print(f"{arr}: {error}")
-            sys.exit(1)
-        except requests.exceptions.HTTPError as error:
-            if "401" in str(error):
-                print(
-                    f"{arr} Error: API key incorrect. "
-                    "Please double check your key and config file."
-                )
-                sys.exit(1)
-            print(f"{arr} Error:")
-            print(f"{arr}: {error}")
-            sys.exit(1)
+        except requests.exceptions.ReadTimeout as error:
+            self.timeouts.stalled(kind, timeout[1])
+            raise self.arr_error(arr, error) from error
+        except (
+            requests.exceptions.ConnectTimeout,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.HTTPError,
+        ) as error:
+            raise self.arr_error(arr, error) from error
 
     def get_id(self, arr, search_term, endpoint, term):
         """sends a request to get get necessary ids"""
-        response = self.arr_get(arr, endpoint, 10)
+        response = self.arr_get(arr, endpoint)
 
         # creates a dict for the term: id
         id_dict = {item[term]: item["id"] for item in response.json()}
 
-        # if it can't find an id for the term error and exit
+        # if it can't find an id for the term error out
         if id_dict.get(search_term) is None:
-            print(
+            raise ArrError(
                 f'{arr} Error: No matching {endpoint if (endpoint != "qualityprofile") else "quality profile"} found.'
             )
-            sys.exit(1)
 
         # return the id
         return id_dict.get(search_term)
 
-    def get_list(self, args, arr):
+    def get_library(self, arr):
         """sends the get request to the movies/series arr endpoint"""
-        response = self.arr_get(arr, f"{self.endpoint[arr][0]}", 10)
-        arr_data = {}
+        if self.max_memory is not None:
+            return self.stream_library(arr)
+        if self.database is not None:
+            return self.database.get_library(arr)
+        response = self.arr_get(arr, f"{self.endpoint[arr][0]}", items=None)
 
         # parsing out the tmdb/tvdb/imdb id's,
         #  monitored status, quality profile id, title, and any tags
-        for item in response.json():
-            arr_data[item[f"{self.endpoint[arr][1]}Id"]] = [
-                item.get("imdbId"),
-                item.get("monitored"),
-                item.get("qualityProfileId"),
-                item.get("title"),
-                item.get("tags"),
-                item.get("hasFile") if (arr == "Radarr") else None,
-                item.get("genres"),
-            ]
+        arr_data = self.workers.submit(
+            parse_library,
+            response.content,
+            f"{self.endpoint[arr][1]}Id",
+            arr == "Radarr",
+            size=len(response.content),
+            min_size=MIN_POOL_BYTES,
+        ).result()
+        self.timeouts.set_items(
+            f"{self.request_url()[0]}/api/v3/{self.endpoint[arr][0]}", len(arr_data)
+        )
+        return arr_data
+
+    def stream_library(self, arr):
+        """
+        get_library within max_memory: the response is decoded an item at a
+        time into a SpillMap, which moves to disk once it's too big to keep
+        """
+        arr_data = SpillMap(spill_limit(self.max_memory))
+        if self.database is not None:
+            return self.database.get_library(arr, arr_data)
+        response = self.arr_get(
+            arr, f"{self.endpoint[arr][0]}", items=None, stream=True
+        )
+        id_field = f"{self.endpoint[arr][1]}Id"
+        try:
+            for item in iter_array(response.iter_content(CHUNK_SIZE)):
+                arr_data[item[id_field]] = library_row(item, arr == "Radarr")
+        except requests.exceptions.RequestException as error:
+            raise self.arr_error(arr, error) from error
+        except ValueError as error:
+            raise ArrError(
+                f"{arr} Error: Unreadable library response. {error}"
+            ) from error
+        finally:
+            response.close()
+        if arr_data.spilled:
+            logger.debug(f"{arr}: library moved to a temporary on-disk store")
+        self.timeouts.set_items(
+            f"{self.request_url()[0]}/api/v3/{self.endpoint[arr][0]}", len(arr_data)
+        )
+        return arr_data
+
+    def get_list(self, job, arr, arr_data=None):
+        """
+        filters the arr library down to the job's ids, returns them and the
+        library (fetched unless an already fetched one is passed)
+        """
+        if arr_data is None:
+            arr_data = self.get_library(arr)
         arr_ids = list(arr_data.keys())
 
         # if its monitored, add to arr ids
-        if args.mon:
+        if job.monitored:
             arr_ids = [key for key, value in arr_data.items() if value[1]]
 
         # get the current filtered arr_ids that qualify for the specified quality profile
-        if args.qualityprofile:
-            qp_id = self.get_id(arr, args.qualityprofile, "qualityprofile", "name")
+        if job.quality_profile:
+            qp_id = self.get_id(arr, job.quality_profile, "qualityprofile", "name")
             arr_ids = list(
                 filter(
                     lambda arr_data_item: arr_data.get(arr_data_item, [None])[2]
@@ -117,8 +252,8 @@ class ArrAPI:
             )
 
         # same as above, but for tags
-        if args.tag:
-            tag_id = self.get_id(arr, args.tag, "tag", "label")
+        if job.tag:
+            tag_id = self.get_id(arr, job.tag, "tag", "label")
             arr_ids = list(
                 filter(
                     lambda arr_tag_item: tag_id
@@ -126,7 +261,7 @@ class ArrAPI:
                     arr_ids,
                 )
             )
-        if arr == "Radarr" and args.missing:
+        if arr == "Radarr" and job.missing:
             arr_ids = list(
                 filter(
                     lambda arr_data_item: arr_data.get(arr_data_item, [None])[5]
@@ -134,8 +269,8 @@ class ArrAPI:
                     arr_ids,
                 )
             )
-        if args.genre:
-            genres = [genre.strip() for genre in args.genre.split(",")]
+        if job.genres:
+            genres = job.genres
             arr_ids = list(
                 filter(
                     lambda arr_genre_data_item: any(
@@ -146,11 +281,175 @@ class ArrAPI:
                 )
             )
 
-        # if imdb id is in arr, add it to the imdb id list
-        arr_imdb = [
-            value[1][0]
-            for value in arr_data.items()
-            if value[1][0] is not None and value[0] in arr_ids
+        return arr_ids, arr_data
+
+    def get_names(self, arr, endpoint, term):
+        """id -> name of an endpoint's items (quality profiles, tags)"""
+        return {item["id"]: item[term] for item in self.arr_get(arr, endpoint).json()}
+
+    def get_backup(self, arr):
+        """
+        the library as compact backup entries, quality profiles and tags are
+        kept by name so they can be matched up on a rebuilt instance
+        """
+        response = self.arr_get(arr, f"{self.endpoint[arr][0]}", items=None)
+        profiles = self.get_names(arr, "qualityprofile", "name")
+        tags = self.get_names(arr, "tag", "label")
+        idtag = self.endpoint[arr][1]
+        entries = []
+        for item in response.json():
+            entry = {
+                idtag: item.get(f"{idtag}Id"),
+                "imdb": item.get("imdbId"),
+                "title": item.get("title"),
+                "monitored": item.get("monitored"),
+                "quality_profile": profiles.get(item.get("qualityProfileId")),
+                "tags": [tags[tag] for tag in item.get("tags") or [] if tag in tags],
+                "root_folder": item.get("rootFolderPath"),
+            }
+            if arr == "Radarr":
+                entry["minimum_availability"] = item.get("minimumAvailability")
+            else:
+                entry["season_folder"] = item.get("seasonFolder")
+                entry["series_type"] = item.get("seriesType")
+            entries.append(entry)
+        return entries
+
+    def import_resource(self, arr, entry, profile_id, root_folder, tag_ids, monitored):
+        """builds the movie/series import resource for a backup entry"""
+        resource = {
+            "title": entry.get("title") or "",
+            f"{self.endpoint[arr][1]}Id": entry[self.endpoint[arr][1]],
+            "qualityProfileId": profile_id,
+            "rootFolderPath": root_folder,
+            "monitored": monitored,
+            "tags": tag_ids,
+        }
+        if arr == "Radarr":
+            resource["minimumAvailability"] = (
+                entry.get("minimum_availability") or "released"
+            )
+            resource["addOptions"] = {"searchForMovie": False}
+        else:
+            # sonarr v3 wants a language profile, v4 ignores it
+            resource["languageProfileId"] = 1
+            resource["seasonFolder"] = entry.get("season_folder", True) is not False
+            resource["seriesType"] = entry.get("series_type") or "standard"
+            resource["addOptions"] = {
+                "monitor": "all" if monitored else "none",
+                "searchForMissingEpisodes": False,
+            }
+        return resource
+
+    def import_items(
+        self,
+        arr,
+        entries,
+        quality_profile=None,
+        tags=None,
+        monitored=None,
+        root_folder=None,
+        chunk_size=100,
+        workers=4,
+    ):
+        """
+        bulk adds backup entries through the arr's batch import endpoint,
+        chunk_size titles per request and up to workers requests at once.
+        an entry keeps its own quality profile/root folder when this instance
+        has them (and its tags and monitored state), the arguments fill in
+        the rest (monitored overrides when set). a batch the arr rejects is
+        split until the titles it won't take are found
+        returns the number of titles added and the entries that failed
+        """
+        profiles = {
+            name: profile_id
+            for profile_id, name in self.get_names(
+                arr, "qualityprofile", "name"
+            ).items()
+        }
+        tag_ids = {
+            label: tag_id
+            for tag_id, label in self.get_names(arr, "tag", "label").items()
+        }
+        root_folders = [
+            folder.get("path") for folder in self.arr_get(arr, "rootfolder").json()
         ]
+        if not profiles or not root_folders:
+            raise ArrError(
+                f"{arr} Error: Restoring needs at least one quality profile and root folder."
+            )
+        if quality_profile is not None and quality_profile not in profiles:
+            raise ArrError(f"{arr} Error: No matching quality profile found.")
+        default_profile = profiles.get(quality_profile, next(iter(profiles.values())))
+        default_root = root_folder or root_folders[0]
+
+        # tags this instance doesn't have (yet) are created
+        labels = set(tags or [])
+        for entry in entries:
+            labels.update(entry.get("tags") or [])
+        for label in sorted(labels - set(tag_ids)):
+            tag_ids[label] = self.arr_post(arr, "tag", {"label": label}).json()["id"]
+
+        batch = [
+            (
+                entry,
+                self.import_resource(
+                    arr,
+                    entry,
+                    profiles.get(entry.get("quality_profile"), default_profile),
+                    entry.get("root_folder")
+                    if entry.get("root_folder") in root_folders
+                    else default_root,
+                    sorted(
+                        {tag_ids[label] for label in entry.get("tags") or []}
+                        | {tag_ids[label] for label in tags or []}
+                    ),
+                    entry.get("monitored") is not False
+                    if monitored is None
+                    else monitored,
+                ),
+            )
+            for entry in entries
+        ]
+
+        def send(items):
+            try:
+                response = self.arr_post(
+                    arr,
+                    f"{self.endpoint[arr][0]}/import",
+                    [resource for _, resource in items],
+                    items=len(items),
+                    label="import",
+                )
+            except ArrError as error:
+                # one title the arr won't take fails its whole batch
+                if len(items) == 1 or not isinstance(
+                    error.__cause__, requests.exceptions.HTTPError
+                ):
+                    logger.warning(str(error))
+                    return 0, [entry for entry, _ in items]
+                half = len(items) // 2
+                first_added, first_failed = send(items[:half])
+                second_added, second_failed = send(items[half:])
+                return first_added + second_added, first_failed + second_failed
+            added = response.json()
+            return (len(added) if isinstance(added, list) else len(items)), []
+
+        added = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for batch_added, batch_failed in executor.map(
+                send,
+                [
+                    batch[start : start + chunk_size]
+                    for start in range(0, len(batch), chunk_size)
+                ],
+            ):
+                added += batch_added
+                failed.extend(batch_failed)
+        return added, failed
 
-        return arr_ids, arr_imdb, arr_data
+    def close(self):
+        """closes the requests session (and keeps what was learned about timeouts)"""
+        self.timeouts.save()
+        self.arr_session.close()
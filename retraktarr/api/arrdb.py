@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+""" reads the arr library straight from radarr.db/sonarr.db (read-only) """
+import json
+import sqlite3
+from urllib.parse import quote
+
+from retraktarr.exceptions import ArrError
+
+
+class ArrDatabase:
+    """
+    read-only access to an arr's sqlite database, for when retraktarr runs
+    on the same host. only the columns retraktarr uses are read, the result
+    is the same arr_data as ArrAPI.get_library
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self, arr):
+        """opens the database read-only (the arr keeps running and writing)"""
+        try:
+            return sqlite3.connect(
+                f"file:{quote(self.db_path)}?mode=ro", uri=True, timeout=10
+            )
+        except sqlite3.Error as error:
+            raise ArrError(
+                f"{arr} Error: Could not open database '{self.db_path}': {error}"
+            ) from error
+
+    @staticmethod
+    def columns(connection, table):
+        """the column names of a table (empty if it doesn't exist)"""
+        return {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+
+    @staticmethod
+    def json_list(value):
+        """tags/genres are stored as json arrays"""
+        if not value or value == "[]":
+            return []
+        try:
+            return json.loads(value) if value else []
+        except ValueError:
+            return []
+
+    def library_query(self, connection, arr):
+        """builds the select for the arr's schema version"""
+        if arr == "Sonarr":
+            series = self.columns(connection, "Series")
+            profile = (
+                "QualityProfileId" if "QualityProfileId" in series else "ProfileId"
+            )
+            return (
+                f"SELECT TvdbId, ImdbId, Monitored, {profile}, Title, Tags, NULL, Genres "
+                "FROM Series"
+            )
+        movies = self.columns(connection, "Movies")
+        profile = "QualityProfileId" if "QualityProfileId" in movies else "ProfileId"
+        # radarr 4+ keeps the ids/title/genres in MovieMetadata
+        if "MovieMetadataId" in movies:
+            return (
+                "SELECT mm.TmdbId, mm.ImdbId, m.Monitored, "
+                f"m.{profile}, mm.Title, m.Tags, m.MovieFileId, mm.Genres "
+                "FROM Movies m JOIN MovieMetadata mm ON m.MovieMetadataId = mm.Id"
+            )
+        return (
+            f"SELECT TmdbId, ImdbId, Monitored, {profile}, Title, Tags, MovieFileId, "
+            "Genres FROM Movies"
+        )
+
+    def get_library(self, arr, arr_data=None):
+        """
+        reads the library into arr_data ({tmdb/tvdb: [imdb, monitored, ...]},
+        or the mapping passed in)
+        """
+        connection = self.connect(arr)
+        try:
+            rows = connection.execute(self.library_query(connection, arr))
+            arr_data = {} if arr_data is None else arr_data
+            for (
+                arr_id,
+                imdb_id,
+                monitored,
+                profile_id,
+                title,
+                tags,
+                file_id,
+                genres,
+            ) in rows:
+                arr_data[arr_id] = [
+                    imdb_id or None,
+                    bool(monitored),
+                    profile_id,
+                    title,
+                    self.json_list(tags),
+                    bool(file_id) if (arr == "Radarr") else None,
+                    self.json_list(genres),
+                ]
+            return arr_data
+        except sqlite3.Error as error:
+            raise ArrError(
+                f"{arr} Error: Could not read database '{self.db_path}': {error}"
+            ) from error
+        finally:
+            connection.close()
@@ -1,30 +1,133 @@
 #!/usr/bin/env python3
 """ handles the trakt api lists and requests (add/delete/etc) """
 import json
+import logging
 import re
-import sys
 import time
 
 import requests
 
-from retraktarr.config import Configuration
+from retraktarr.cache import (
+    DAY,
+    IDCrossReference,
+    ListRegistry,
+    ListSnapshot,
+    NotFoundCache,
+)
+from retraktarr.exceptions import ListLimitError, TraktAuthError, TraktError
+from retraktarr.journal import SyncJournal
+from retraktarr.models import ListItem
+from retraktarr.parallel import (
+    MIN_POOL_BYTES,
+    WorkerPool,
+    diff_ids,
+    id_array,
+    parse_list,
+)
+from retraktarr.ratelimit import TRAKT_GET_LIMIT, TRAKT_POST_LIMIT, SharedRateLimiter
+from retraktarr.schedule import LatencyModel, fit_ops, op_items
+from retraktarr.spill import spill_limit, sql_diff
+from retraktarr.state import StateStore
+from retraktarr.timeouts import TimeoutModel
+
+logger = logging.getLogger(__name__)
 
 
 class TraktAPI:
     """trakt API handler class"""
 
-    def __init__(self, oauth2_bearer, trakt_api_key, trakt_user, trakt_secret):
+    def __init__(
+        self,
+        oauth2_bearer,
+        trakt_api_key,
+        trakt_user,
+        trakt_secret,
+        state=None,
+        config=None,
+        account="Trakt",
+        xref=None,
+        timeouts=None,
+    ):
         self.oauth2_bearer = oauth2_bearer
         self.trakt_api_key = trakt_api_key
         self.user = trakt_user
         self.trakt_secret = trakt_secret
         self.list = ""
+        # the list's trakt id (None if it doesn't exist yet) and what its urls use
+        self.list_id = None
+        self.list_ref = ""
         self.json = {}
+        # (type, trakt id) -> title of self.json's items, built when first needed
+        self.titles = None
+        # reports leave titles out (summary), skips looking them up
+        self.report_titles = True
         self.response = None
         self.list_len = []
         self.list_privacy = "public"
         self.list_limit = 1000
-        self.post_timeout = 60
+        self.list_count_limit = None
+        # overrides the per request POST read timeouts when set
+        self.post_timeout = None
+        self.list_exists = True
+        # items per POST, retries (with exponential backoff) before giving up
+        self.chunk_size = 500
+        self.retries = 3
+        self.backoff = 2
+        # how long ids trakt can't find are left out of adds before re-probing (0 = off)
+        self.not_found_ttl = 7 * DAY
+        # max trakt id lookups per run for arr items the cross reference doesn't know
+        self.lookup_limit = 0
+        # keep a local copy of each list and only download it when trakt's
+        # updated_at/item_count says someone else changed it
+        self.use_snapshot = True
+        self.snapshot = None
+        # users/settings (the list limits) is cached for settings_ttl seconds,
+        # sync/last_activities is read at most once per activity_ttl seconds and
+        # lets lists whose snapshot is still current skip every list GET
+        self.settings_ttl = DAY
+        self.limits_fresh = False
+        self.activity_ttl = 60
+        self.activity = None
+        self.activity_checked = None
+        # decodes big lists and diffs in worker processes (SyncEngine shares its pool)
+        self.workers = WorkerPool()
+        # bytes a diff may take up (--max-memory), bigger ones are run as
+        # queries on a temporary on-disk database. None diffs in memory
+        self.max_memory = None
+        self.deleted = {}
+        # [arr id, trakt id, trakt's id (tmdb/tvdb or imdb)] of listed items
+        # trakt or the arr has an outdated id for
+        self.corrections = []
+        # pending operations resumed from an interrupted run, and the titles
+        # their adds added (movies/shows -> count)
+        self.resumed = 0
+        self.resumed_added = {}
+        # the configuration (and section) the tokens came from, for automatic refreshes
+        self.config = config
+        self.account = account
+        self.state = state if state is not None else StateStore()
+        # trakt rate limits are per user, so every account gets its own budget,
+        # shared with any other retraktarr process using the same state directory
+        self.get_limiter = SharedRateLimiter(
+            *TRAKT_GET_LIMIT,
+            self.state.path(self.state.key("ratelimit", trakt_user, "get")),
+        )
+        self.post_limiter = SharedRateLimiter(
+            *TRAKT_POST_LIMIT,
+            self.state.path(self.state.key("ratelimit", trakt_user, "post")),
+        )
+        self.xref = xref if xref is not None else IDCrossReference(self.state).load()
+        # the account's lists (users/{user}/lists), cached for a day
+        self.list_registry = ListRegistry(self.state, trakt_user).load()
+        # learned response times per host, every request's timeouts come from them
+        self.timeouts = (
+            timeouts if timeouts is not None else TimeoutModel(self.state).load()
+        )
+        # time.monotonic() by which posts should be done, what wouldn't fit
+        # (going by the observed post latencies) is left for the next run
+        self.deadline = None
+        self.latency = LatencyModel(self.state, trakt_user).load()
+        self.last_post_seconds = 0
         self.trakt_session = requests.Session()
         self.trakt_hdr = {
             "Content-Type": "application/json",
@@ -52,467 +155,1024 @@ class TraktAPI:
         normalized = re.sub(r"-+", "-", normalized)
         return normalized.strip("-")
 
-    def get_trakt(self, path, args, media_type, timeout):
-        """gets json response from the specified path for applicable media_type (show/movie)"""
+    def get_trakt(self, path, media_type, items=0, attempt=0):
+        """
+        gets json response from the specified path for applicable media_type (show/movie)
+        items is how many items the response is expected to list (sizes its timeout)
+        """
         response = None
-        time.sleep(1)
+        url = f"https://api.trakt.tv/{path}"
+        # list items are learned apart, they cost a lot more than anything else
+        listing = path.endswith("/items")
+        kind = self.timeouts.kind("GET", url, "items" if listing else None)
+        timeout = self.timeouts.timeout(kind, items, cold=30 if listing else 10)
+        self.get_limiter.acquire()
         try:
+            started = time.perf_counter()
             response = self.trakt_session.get(
-                f"https://api.trakt.tv/{path}", headers=self.trakt_hdr, timeout=timeout
+                url, headers=self.trakt_hdr, timeout=timeout
             )
             response.raise_for_status()
             if response.status_code != 200:
-                print(
+                raise TraktError(
                     f"Trakt.tv Error: Unexpected status code return: {response.status_code}."
                 )
-                sys.exit(1)
-            else:
-                return response
-        except requests.exceptions.ConnectTimeout:
-            print("Trakt.tv Error: Connection Timed Out. Check your internet.")
-            sys.exit(1)
+            self.timeouts.observe(kind, items, response, time.perf_counter() - started)
+            return response
+        except requests.exceptions.ConnectTimeout as error:
+            raise TraktError(
+                "Trakt.tv Error: Connection Timed Out. Check your internet."
+            ) from error
+        except requests.exceptions.ReadTimeout as error:
+            # stalled, or slower than it's ever been, retry with more time
+            self.timeouts.stalled(kind, timeout[1])
+            if self.retry_wait(attempt):
+                return self.get_trakt(path, media_type, items, attempt + 1)
+            raise TraktError(
+                "Trakt.tv Error: Connection Timed Out Mid-Stream. Check your internet."
+            ) from error
         except requests.exceptions.ConnectionError as error:
-            print("Trakt.tv: Connection Error. Check your internet.")
-            print(f"{error}")
-            sys.exit(1)
+            raise TraktError(
+                f"Trakt.tv: Connection Error. Check your internet.\n{error}"
+            ) from error
         except requests.exceptions.HTTPError as error:
             # checks if the list is missing mostly
             if "404" in str(error):
                 return 404
+            # rate limited, wait out trakt's Retry-After and try again
+            if "429" in str(error):
+                retry_after = error.response.headers.get("Retry-After")
+                if retry_after is not None and retry_after.isdigit():
+                    self.get_limiter.pause(int(retry_after))
+                if self.retry_wait(attempt, retry_after):
+                    return self.get_trakt(path, media_type, items, attempt + 1)
+                raise TraktError(f"Trakt.tv Error: {error}") from error
             # checks if an oauth_refresh token is available
             # and if so assume that the token has expired and attempt a refresh automatically
             if "401" in str(error) or "400" in str(error) or "403" in str(error):
-                config = Configuration("retraktarr.conf")
-
                 # checks the config for the refresh, if exists, update the
                 # header and rerun the command and return original intended results
                 if (
-                    config.conf.get("Trakt", "oauth2_refresh")
+                    self.config is not None
+                    and self.config.conf.get(
+                        self.account, "oauth2_refresh", fallback=""
+                    )
                     and self.oauth2_bearer
                     == self.trakt_hdr.get("Authorization").split(" ")[1]
                 ):
-                    print(
+                    logger.warning(
                         "Error: You may have a expired token. Attempting a refresh command."
                     )
 
                     # refresh the header with the new auth, update the config file with new tokens
-                    self.refresh_header(config.get_oauth(args, True))
-                    time.sleep(1)
+                    self.refresh_header(
+                        self.config.get_oauth(refresh=True, section=self.account)
+                    )
 
                     # return the intended original results
-                    return self.get_trakt(path, args, media_type, timeout=timeout)
+                    return self.get_trakt(path, media_type, items)
 
                 # no oauth_refresh token is available, error out.
-                print(
+                raise TraktAuthError(
                     "Error: You likely have a bad ClientID/Secret or expired/invalid token."
                     "\nPlease check your config and attempt the refresh or oauth command (-o) again"
-                )
-                sys.exit(1)
-            print(
+                ) from error
+            raise TraktError(
                 f"Trakt.tv Error: Unexpected status code return: {response.status_code}."
+            ) from error
+
+    def get_limits(self, media_type, refresh=False):
+        """
+        sets the list limits (items per list, lists) from the users settings,
+        cached in the state directory for settings_ttl unless refresh is set
+        """
+        name = self.state.key("settings", self.user)
+        cached = self.state.load(name, {})
+        if (
+            not refresh
+            and cached
+            and time.time() - cached.get("fetched", 0) < self.settings_ttl
+        ):
+            limits = cached.get("limits", {})
+            self.limits_fresh = False
+        else:
+            response = self.get_trakt("users/settings", media_type)
+            limits = response.json().get("limits", {}).get("list", {})
+            self.state.save(name, {"fetched": time.time(), "limits": limits})
+            self.limits_fresh = True
+        self.list_limit = limits.get("item_count", None)
+        self.list_count_limit = limits.get("count", None)
+
+    def get_activity(self, media_type):
+        """
+        the account's last list activity (sync/last_activities), any change
+        to any of the user's lists moves it. read at most once per activity_ttl
+        """
+        now = time.monotonic()
+        if self.activity_checked is None or now - self.activity_checked >= (
+            self.activity_ttl
+        ):
+            response = self.get_trakt("sync/last_activities", media_type)
+            self.activity = (
+                None
+                if response == 404
+                else response.json().get("lists", {}).get("updated_at")
             )
-            sys.exit(1)
+            self.activity_checked = now
+        return self.activity
 
-    def get_list(self, args, media_type):
-        """ " gets the specified trakt list and settings (account limits)"""
+    def find_list(self, media_type, refresh=False):
+        """
+        looks the list up in the account's list registry, refetching it once
+        it's older than its ttl (or if the list isn't in it, it may have been
+        made since, or refresh is set). sets list_id and list_ref, returns the
+        list's trakt id (None if the account has no such list)
+        """
+        slug = self.normalize_trakt(self.list)
+        list_id = self.list_registry.find(self.list, slug)
+        if (
+            refresh
+            or self.list_registry.age() >= self.list_registry.ttl
+            or (list_id is None and self.list_registry.age() >= self.activity_ttl)
+        ):
+            self.fetch_lists(media_type)
+            list_id = self.list_registry.find(self.list, slug)
+        self.list_id = list_id
+        self.list_ref = slug if list_id is None else str(list_id)
+        return list_id
 
-        # grabs the users settings and sets the list limits
-        response = self.get_trakt("users/settings", args, media_type, timeout=10)
-        self.list_limit = (
-            response.json().get("limits", {}).get("list", {}).get("item_count", None)
+    def fetch_lists(self, media_type):
+        """refetches the account's lists into the list registry"""
+        response = self.get_trakt(
+            f"users/{self.normalize_trakt(self.user)}/lists", media_type
         )
+        self.list_registry.replace([] if response == 404 else response.json())
+        self.list_registry.save()
 
-        # sends a get request for the list and all of its items
-        response = self.get_trakt(
-            f"users/{self.normalize_trakt(self.user)}/lists/{self.normalize_trakt(self.list)}/items",
-            args,
-            media_type,
-            timeout=30,
+    def account_lists(self, media_type):
+        """the account's lists (registry entries), refetched unless just fetched"""
+        if self.list_registry.age() >= self.activity_ttl:
+            self.fetch_lists(media_type)
+        return list(self.list_registry.lists.values())
+
+    def created_list(self, list_info):
+        """records a list we just created, posts to it go to its trakt id"""
+        list_id = self.list_registry.add(list_info)
+        if list_id is not None:
+            self.list_registry.save()
+            self.list_id = list_id
+            self.list_ref = str(list_id)
+
+    def create_list(self, media_type, body, resumed=False):
+        """
+        creates the list (body is the lists post) and returns its list object.
+        unlike adding/removing items creating isn't idempotent, so it's never
+        just resent: after a try that may have gone through anyway (timeouts,
+        connection errors, 5xx) and before a create resumed from an interrupted
+        run, the account's lists are refetched and an existing list is used
+        """
+        attempt = 0
+        check = resumed
+        while True:
+            if check and self.find_list(media_type, refresh=True) is not None:
+                logger.info(f"Trakt.tv: ({self.list}) already exists, using it.\n")
+                return {"ids": {"trakt": self.list_id}}
+            logger.info(
+                f"Creating {self.list_privacy} Trakt.tv list: ({self.list})...\n"
+            )
+            try:
+                response = self.post_trakt(self.list, "lists", body, media_type)
+            except TraktError as error:
+                cause = error.__cause__
+                status_code = getattr(
+                    getattr(cause, "response", None), "status_code", None
+                )
+                if not (
+                    isinstance(
+                        cause,
+                        (
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout,
+                        ),
+                    )
+                    or (status_code or 0) >= 500
+                ) or not self.retry_wait(attempt):
+                    raise
+                attempt += 1
+                check = True
+                continue
+            self.created_list(response.json())
+            return response.json()
+
+    def list_path(self, path):
+        """points a lists/{list}/... post path at the list's current list_ref"""
+        return re.sub(r"^lists/[^/]+/", f"lists/{self.list_ref}/", path)
+
+    def get_list(self, media_type, resume=True):
+        """
+        gets the specified trakt list and settings (account limits), returns
+        the trakt ids of its items (the items are in self.json). without
+        resume nothing is sent: a list with operations pending from an
+        interrupted run raises a TraktError instead of them being resumed
+        """
+        self.snapshot = (
+            ListSnapshot(self.state, self.user, self.list).load()
+            if self.use_snapshot
+            else None
         )
 
-        # returns empty lists if the list does not exist
-        if response == 404:
-            return [], [], [], []
+        # the list's id comes first, anything resumed below is sent to it
+        self.find_list(media_type)
 
-        # sets all of the ids into lists for parsing/adding/logic
-        self.list_len = [
-            item.get("id", {}) for item in response.json() if item.get("id", {})
-        ]
+        # finish whatever an interrupted run left behind before looking at the list
+        self.resumed = 0
+        self.resumed_added = {}
+        if resume:
+            self.resumed = self.resume_journal(media_type)
+        elif SyncJournal(self.state, self.user, self.list).load():
+            raise TraktError(
+                f"Trakt.tv Error: ({self.list}) has operations pending from an "
+                "interrupted run, sync it before planning it."
+            )
 
-        tvdb_ids = [
-            item.get(media_type, {}).get("ids", {}).get("tvdb")
-            for item in response.json()
-            if item.get(media_type, {}).get("ids", {}).get("tvdb") is not None
-        ]
+        # grabs the users settings and sets the list limits
+        self.get_limits(media_type)
 
-        tmdb_ids = [
-            item.get(media_type, {}).get("ids", {}).get("tmdb")
-            for item in response.json()
-            if item.get(media_type, {}).get("ids", {}).get("tmdb") is not None
-        ]
+        list_path = f"users/{self.normalize_trakt(self.user)}/lists/{self.list_ref}"
+        items = None
+        list_info = {}
+        activity = None
+        # a list that isn't in the (just refetched) registry doesn't exist,
+        # there's no need for a 404 to tell
+        missing = self.list_id is None
+        if self.snapshot is not None and not missing:
+            activity = self.get_activity(media_type)
+            if self.snapshot.unchanged(activity):
+                # none of the account's lists changed since the snapshot was checked
+                logger.debug(
+                    f"Trakt.tv: no list activity, using snapshot of ({self.list})"
+                )
+                items = list(self.snapshot.items)
+            else:
+                # the list's metadata is a lot cheaper than its items, if it
+                # still matches our snapshot nobody else has touched the list
+                response = self.get_trakt(list_path, media_type)
+                if response != 404:
+                    list_info = response.json()
+                    if self.snapshot.matches(list_info):
+                        logger.debug(
+                            f"Trakt.tv: ({self.list}) unchanged, using snapshot"
+                        )
+                        items = list(self.snapshot.items)
+                        self.snapshot.activity = activity
+                        self.snapshot.save()
+
+        # sends a get request for the list and all of its items
+        response = 404 if missing else None
+        if items is None and not missing:
+            response = self.get_trakt(
+                f"{list_path}/items",
+                media_type,
+                items=list_info.get(
+                    "item_count",
+                    self.timeouts.expected_items(f"https://api.trakt.tv/{list_path}")
+                    or self.list_registry.entry(self.list_id).get("item_count", 0),
+                ),
+            )
 
-        imdb_ids = [
-            item.get(media_type, {}).get("ids", {}).get("imdb")
-            for item in response.json()
-            if item.get(media_type, {}).get("ids", {}).get("imdb") is not None
+        # returns no ids if the list does not exist
+        if response == 404:
+            if self.list_id is not None:
+                # deleted since the registry was fetched
+                self.list_registry.forget(self.list_id)
+                self.list_registry.save()
+                self.list_id = None
+                self.list_ref = self.normalize_trakt(self.list)
+            self.list_exists = False
+            self.list_len = []
+            self.json = []
+            self.titles = None
+            if self.snapshot is not None:
+                self.snapshot.replace([], {})
+                self.snapshot.save()
+            return []
+        self.list_exists = True
+        if items is None:
+            items = self.workers.submit(
+                parse_list,
+                response.content,
+                size=len(response.content),
+                min_size=MIN_POOL_BYTES,
+            ).result()
+            self.timeouts.set_items(f"https://api.trakt.tv/{list_path}", len(items))
+            if self.snapshot is not None:
+                self.snapshot.replace(items, list_info)
+                self.snapshot.activity = activity
+                self.snapshot.save()
+
+        # sets all of the ids into lists for parsing/adding/logic
+        self.list_len = [
+            item.get("id", {}) for item in items if item.get("type") is not None
         ]
 
         # makes a list of all trakt ids so we have every single item
         # guarenteed (we use this id for wiping)
         trakt_ids = [
             item.get("movie", {}).get("ids", {}).get("trakt")
-            for item in response.json()
+            for item in items
             if item.get("movie", {}).get("ids", {}).get("trakt") is not None
         ]
-        for item in response.json():
+        for item in items:
             if item.get("show", {}).get("ids", {}).get("trakt") is not None:
                 trakt_ids.append(item.get("show", {}).get("ids", {}).get("trakt"))
 
         # spit out the lists and json to main
-        self.json = response.json()
-        return tvdb_ids, tmdb_ids, imdb_ids, trakt_ids
+        self.json = items
+        self.titles = None
+        self.xref.learn_list(self.json)
+        return trakt_ids
+
+    def retry_wait(self, attempt, retry_after=None):
+        """waits out an exponential backoff, returns False when out of retries"""
+        if attempt >= self.retries:
+            return False
+        wait = self.backoff * (2**attempt)
+        if retry_after is not None and retry_after.isdigit():
+            wait = max(wait, int(retry_after))
+        logger.info(f"Trakt.tv: Retrying in {wait}s ({attempt + 1}/{self.retries})...")
+        time.sleep(wait)
+        return True
 
-    def post_trakt(self, list_name, path, post_json, args, media_type, timeout):
+    def post_trakt(self, list_name, path, post_json, media_type, items=0, attempt=0):
         """
         sends a post command to trakt
-        post_json is json.dumps'd json, path is the url to append to the user url
+        post_json is json.dumps'd json or a {type: [items]} body
+        path is the url to append to the user url
+        items is how many items it sends (sizes its timeout)
+        timeouts, connection errors, 429s and 5xx responses are retried with backoff
+        (list add/remove are idempotent so resending a chunk is harmless, list
+        creations are only resent when they can't have reached trakt, see create_list)
         """
+        resend = path != "lists"
+        url = f"https://api.trakt.tv/users/{self.normalize_trakt(self.user)}/{path}"
+        data = json.dumps(post_json) if isinstance(post_json, dict) else post_json
+        size = len(data)
+        kind = self.timeouts.kind("POST", url)
+        timeout = self.timeouts.timeout(kind, items, size, cold=60)
+        if self.post_timeout is not None:
+            timeout = (timeout[0], self.post_timeout)
 
-        time.sleep(1)
+        self.post_limiter.acquire()
+        started = time.perf_counter()
         try:
             response = self.trakt_session.post(
-                f"https://api.trakt.tv/users/{self.normalize_trakt(self.user)}/{path}",
+                url,
                 headers=self.trakt_hdr,
-                data=post_json,
-                timeout=timeout if not args.timeout else self.post_timeout,
+                data=data,
+                timeout=timeout,
             )
             response.raise_for_status()
             if response.status_code in (200, 201, 204):
+                self.last_post_seconds = time.perf_counter() - started
+                self.timeouts.observe(
+                    kind, items, response, self.last_post_seconds, size
+                )
                 return response
-        except requests.exceptions.ConnectTimeout:
-            print("Trakt.tv Error: Connection Timed Out. Check your internet.")
-            sys.exit(1)
-        except requests.exceptions.ReadTimeout:
-            print(
-                "Trakt.tv Error: Connection Timed Out Mid-Stream. Increase your --timeout. "
+            raise TraktError(
+                f"Trakt.tv Error: Unexpected status code return: {response.status_code}."
             )
-            sys.exit(1)
+        except requests.exceptions.ConnectTimeout as error:
+            if self.retry_wait(attempt):
+                return self.post_trakt(
+                    list_name, path, post_json, media_type, items, attempt + 1
+                )
+            raise TraktError(
+                "Trakt.tv Error: Connection Timed Out. Check your internet."
+            ) from error
+        except requests.exceptions.ReadTimeout as error:
+            self.timeouts.stalled(kind, timeout[1])
+            if resend and self.retry_wait(attempt):
+                return self.post_trakt(
+                    list_name, path, post_json, media_type, items, attempt + 1
+                )
+            raise TraktError(
+                "Trakt.tv Error: Connection Timed Out Mid-Stream. Increase your --timeout. "
+            ) from error
         except requests.exceptions.ConnectionError as error:
-            print("Trakt.tv: Connection Error. Check your internet.")
-            print(f"{error}")
-            sys.exit(1)
+            if resend and self.retry_wait(attempt):
+                return self.post_trakt(
+                    list_name, path, post_json, media_type, items, attempt + 1
+                )
+            raise TraktError(
+                f"Trakt.tv: Connection Error. Check your internet.\n{error}"
+            ) from error
         except requests.exceptions.HTTPError as error:
+            # rate limited or trakt is having a moment, back off and resend
+            status_code = (
+                error.response.status_code if error.response is not None else 0
+            )
+            if status_code == 429 or (resend and status_code >= 500):
+                retry_after = error.response.headers.get("Retry-After")
+                if retry_after is not None and retry_after.isdigit():
+                    self.post_limiter.pause(int(retry_after))
+                if self.retry_wait(attempt, retry_after):
+                    return self.post_trakt(
+                        list_name, path, post_json, media_type, items, attempt + 1
+                    )
+                raise TraktError(f"Trakt.tv Error: {error}") from error
             # http error parsing
             if "401" in str(error) or "403" in str(error):
-                print(
+                raise TraktAuthError(
                     "Trakt.tv Error: You likely have a bad OAuth2 Token, "
                     "username, or ClientID/API key.\n"
                     "Please check your config, revalidate with the oauth2 "
                     "command, and try again."
-                )
-                sys.exit(1)
-            elif "420" in str(error):
-                print(
+                ) from error
+            if "420" in str(error):
+                raise ListLimitError(
                     "Trakt.tv Error:"
                     f"Your additions to ({list_name}) exceeds your item limits."
                     "You will need Trakt VIP."
+                ) from error
+            if "404" not in str(error) or not resend:
+                raise TraktError(f"Trakt.tv Error: {error}") from error
+            # the list was deleted since it was looked up, we create it
+            # then rerun the same post commands (at the new list's id)
+            # return the response as if nothing happened :)
+            logger.warning(
+                "Trakt.tv Error (404): "
+                f"https://trakt.tv/users/{self.normalize_trakt(self.user)}/lists/{self.list_ref} not found...\n"
+            )
+            self.list_registry.forget(self.list_id)
+            trakt_add_list = {
+                "name": self.list,
+                "description": "Created using retraktarr "
+                "(https://github.com/zakkarry/retraktarr)",
+                "privacy": self.list_privacy,
+                "allow_comments": False,
+            }
+            # adds the list
+            self.create_list(media_type, json.dumps(trakt_add_list))
+
+            # retry the POST (paced by the post limiter) and returns the intended original results
+            return self.post_trakt(
+                self.list, self.list_path(path), post_json, media_type, items
+            )
+
+    def resolve_ids(self, media_type, idtag, arr_ids, arr_data):
+        """
+        looks up trakt ids for arr items the cross reference hasn't seen yet
+        (trakt has no bulk lookup, so this is capped at lookup_limit per run)
+        """
+        lookups = 0
+        for arr_id in arr_ids:
+            if lookups >= self.lookup_limit:
+                break
+            if self.xref.trakt_id(
+                media_type, idtag, arr_id, arr_data.get(arr_id, [None])[0]
+            ):
+                continue
+            lookups += 1
+            response = self.get_trakt(
+                f"search/{idtag}/{arr_id}?type={media_type}",
+                media_type,
+            )
+            if response == 404:
+                continue
+            for result in response.json():
+                self.xref.learn(
+                    result.get("type"),
+                    result.get(result.get("type"), {}).get("ids", {}),
                 )
-                sys.exit(1)
-            elif "404" in str(error):
-                # if the list doesn't exist, we create it
-                # then rerun the same post commands
-                # return the response as if nothing happened :)
-                print(
-                    "Trakt.tv Error (404): "
-                    f"https://trakt.tv/users/{self.normalize_trakt(self.user)}/lists/{self.normalize_trakt(self.list)} not found...\n"
-                )
-                trakt_add_list = {
-                    "name": self.list,
-                    "description": "Created using retraktarr "
-                    "(https://github.com/zakkarry/retraktarr)",
-                    "privacy": self.list_privacy,
-                    "allow_comments": False,
-                }
-                # adds the list
-                self.post_trakt(
-                    self.list,
-                    "lists",
-                    json.dumps(trakt_add_list),
-                    args,
-                    media_type,
-                    timeout=15,
-                )
-                print(f"Creating {self.list_privacy} Trakt.tv list: ({self.list})...\n")
-                time.sleep(1)
-
-                # retry the POST and returns the intended original results
-                response = self.post_trakt(
-                    self.list,
-                    path,
-                    post_json,
-                    args,
-                    media_type,
-                    timeout=timeout if not args.timeout else self.post_timeout,
-                )
-                return response
+
+    def start_diff(self, job, media_type, arr_data, idtag, arr_ids, all_trakt_ids):
+        """
+        resolves the arr ids to trakt ids (through the id cross reference) and
+        hands their comparison with the list to the worker pool as compact id
+        arrays. returns what del_from_list needs: the Future of diff_ids's
+        result, the arr ids and listed ids its positions refer to and the
+        listed items matched on tmdb/tvdb whose imdb ids disagree
+        """
+        list_type = media_type.rstrip("s")
+        if self.lookup_limit and not job.wipe:
+            self.resolve_ids(list_type, idtag, arr_ids, arr_data)
+
+        # the ids of every item of this type on the list
+        listed = [
+            item[list_type]["ids"]
+            for item in self.json
+            if item.get("type") == list_type
+            and item[list_type].get("ids", {}).get("trakt") is not None
+        ]
+        listed_trakt_ids = {ids["trakt"] for ids in listed}
+        mismatched = []
+
+        def resolve(arr_id):
+            imdb_id = arr_data.get(arr_id, [None])[0]
+            trakt_id = self.xref.trakt_id(
+                list_type, idtag, arr_id, imdb_id, listed_trakt_ids
+            )
+            # kept on a tmdb/tvdb match, but one of the imdb ids is outdated
+            trakt_imdb = self.xref.imdb_id(list_type, trakt_id)
+            if (
+                not job.wipe
+                and trakt_id in listed_trakt_ids
+                and None not in (imdb_id, trakt_imdb)
+                and imdb_id != trakt_imdb
+            ):
+                mismatched.append([arr_id, trakt_id, trakt_imdb])
+            return trakt_id
+
+        diff = diff_ids
+        if self.max_memory is not None and len(arr_ids) + len(listed) > spill_limit(
+            self.max_memory
+        ):
+            diff = sql_diff
+        future = self.workers.submit(
+            diff,
+            id_array(arr_ids),
+            id_array(resolve(arr_id) for arr_id in arr_ids),
+            id_array(ids["trakt"] for ids in listed),
+            id_array(ids.get(idtag) for ids in listed),
+            job.wipe,
+            not job.cat and not job.wipe and len(all_trakt_ids) > 0,
+            size=len(arr_ids) + len(listed),
+        )
+        return future, list(arr_ids), listed, mismatched
 
     def del_from_list(
         self,
-        args,
+        job,
         media_type,
         arr_data,
-        trakt_ids,
         idtag,
-        trakt_imdb_ids,
         arr_ids,
-        arr_imdb,
         all_trakt_ids,
+        planned=0,
+        diffed=None,
     ):
         """
-        super complicated logic to find and identify unneeded ids
-        and remove them from the trakt list before adding
+        finds the unneeded items that need to be removed from the trakt list
+        before adding, and the arr ids that still need adding. everything is
+        compared on trakt ids (resolved through the id cross reference), so
+        items with outdated tmdb/tvdb ids on trakt don't get removed/readded
+        (diffed is an already started start_diff's result)
+        returns the needed ids, the removal json (if any) and the removed trakt ids
         """
-        trakt_del, extra_imdb_ids, extra_ids, filtered_extra_imdb_ids, wrong_ids = (
-            [] for i in range(5)
-        )
-        if not args.cat:  # not catenating to the list
-            if len(all_trakt_ids) > 0:  # if the trakt list already has contents
-                # if we're not wiping the entire list (--wipe)
-                if not args.wipe:
-                    needed_ids = set(arr_ids) - set(trakt_ids)
-                    # set needed ids to all wanted ids from arr minus whats already on the list
-
-                    extra_ids = set(trakt_ids) - set(arr_ids)
-                    # all items from the list minus what is in arrs - tmdb/tvdb to be removed
-
-                    extra_imdb_ids = set(trakt_imdb_ids) - set(arr_imdb)
-                    # same as above, but specifically imdbids in case tmdb/tvdb is missing
-
-                    # run through trakt's API json response for the list
-                    # check the type of media and compare to what arr's media is
-                    # see if the idtag (tvdb/tmdb) is missing
-                    # and add the imdb id from trakt to a filtered extra's list
-                    filtered_extra_imdb_ids = [
-                        data[media_type.rstrip("s")]["ids"].get("imdb")
-                        for data in filter(
-                            lambda data: data["type"] == media_type.rstrip("s")
-                            and data[media_type.rstrip("s")]["ids"].get(idtag) is None
-                            and data[media_type.rstrip("s")]["ids"].get("imdb")
-                            in extra_imdb_ids,
-                            self.json,
-                        )
-                    ]
-
-                    # check if there are extra tmdb/tvdb id's to be removed from trakt
-                    # skip if wipe since we'd remove all
-                    if len(extra_ids) > 0 and not args.wipe:
-                        trakt_del = {media_type: []}
-                        # create a dictionary for 'imdb' values in arr_data that could be wrong
-                        arr_imdb_lookup = {
-                            value[1][0]: value[0]
-                            for value in arr_data.items()
-                            if value[0] in needed_ids
-                        }
-                        # run through extra_ids
-                        # check if the extra_id from trakt doesnt exist in arrs
-                        # (almost always deleted/outdate trakt info)
-                        for item in extra_ids:
-                            if item not in arr_ids:
-                                # if it isn't in our arr, append to the delete json
-                                # we will readd if its on the needed_ids list later.
-                                trakt_del[media_type].append({"ids": {idtag: item}})
-
-                                # checks if the tmdb/tvdb is not in the arr's db
-                                # ends up determining if the id is wrong and it will be readded
-                                if item not in arr_data.keys():
-                                    # run through the json
-                                    for data in self.json:
-                                        # check if the tvdb/tmdb id is in the arr
-                                        if (
-                                            data[media_type.rstrip("s")]["ids"].get(
-                                                idtag
-                                            )
-                                            == item
-                                        ) and (
-                                            data[media_type.rstrip("s")]["ids"].get(
-                                                "imdb"
-                                            )
-                                            in arr_imdb_lookup
-                                        ):
-                                            # if the imdb id is correct but tmdb/tvdb is not, add to wrong_ids
-                                            wrong_ids.append(item)
-                                            break
-                    # remove the needed wrong ids from extra_ids so they dont delete
-                    extra_ids = set(extra_ids) - set(wrong_ids)
-
-                    # takes the filtered extra imdb ids
-                    # (missing a corresponding tmdb/tvdb from arr on trakt)
-                    if len(filtered_extra_imdb_ids) > 0 and not args.wipe:
-                        # if there's no extra_ids (tvdb/tmdb)
-                        # just build the entire json for imdb since it would be empty anyway
-                        if len(extra_ids) == 0:
-                            trakt_del = {
-                                media_type: [
-                                    {"ids": {"imdb": item}}
-                                    for item in filtered_extra_imdb_ids
-                                ]
-                            }
-                        # else, run through the filtered id's
-                        # append the imdbid's without corresponding tvdb/tmdb in arr for removal
-                        else:
-                            for item in filtered_extra_imdb_ids:
-                                trakt_del[media_type].append({"ids": {"imdb": item}})
-
-                # if filtered is less is 0 or wipe, set needed_ids to all
-                # build a json to delete everything (in case of wipe)
-                # we wont run delete if the list is empty anyway...
-                else:
-                    needed_ids = set(arr_ids)
-                    trakt_del = {
-                        "shows": [{"ids": {"trakt": item}} for item in all_trakt_ids],
-                        "movies": [{"ids": {"trakt": item}} for item in all_trakt_ids],
-                    }
-            else:
-                needed_ids = set(arr_ids)
-        else:
-            needed_ids = set(arr_ids)
+        list_type = media_type.rstrip("s")
+        trakt_del = None
+        if diffed is None:
+            diffed = self.start_diff(
+                job, media_type, arr_data, idtag, arr_ids, all_trakt_ids
+            )
+        future, arr_ids, listed, mismatched = diffed
+        needed_ids, extra, correction_pairs = future.result()
+        needed_ids = set(needed_ids)
+        extra_ids = {listed[position]["trakt"] for position in extra}
+
+        if not job.cat and len(all_trakt_ids) > 0:
+            # wiping, remove everything (by trakt id) and add it all back
+            if job.wipe:
+                trakt_del = {
+                    "shows": [{"ids": {"trakt": item}} for item in all_trakt_ids],
+                    "movies": [{"ids": {"trakt": item}} for item in all_trakt_ids],
+                }
+            # anything listed that no wanted arr item resolves to goes
+            elif len(extra_ids) > 0:
+                trakt_del = {
+                    media_type: [{"ids": {"trakt": item}} for item in extra_ids]
+                }
+
         # does some calculations on what the end list count would be
-        # compares to your trakt list limits
+        # compares to your trakt list limits (rechecking cached limits with
+        # trakt first, the account may have gone vip since they were fetched)
         if (
-            (
-                len(self.list_len)
-                + len(needed_ids)
-                - len(extra_ids)
-                - len(filtered_extra_imdb_ids)
-            )
-            > self.list_limit
-        ) or (args.wipe and (len(needed_ids) > self.list_limit)):
-            print(
+            self.over_limit(job, needed_ids, extra_ids, planned)
+            and not self.limits_fresh
+        ):
+            self.get_limits(list_type, refresh=True)
+        if self.over_limit(job, needed_ids, extra_ids, planned):
+            raise ListLimitError(
                 f"Error: Your additions to ({self.list}) exceeds your item limits."
                 "You will need Trakt VIP."
             )
-            sys.exit(1)
 
-        # checks if there are extra ids to be removed
-        # or list has items and a wipe was requested
-        # since we removed wrong id's this wont be ran if there is nothing but wrong ids....
-        if (len(extra_ids) > 0 or len(filtered_extra_imdb_ids) > 0) or (
-            args.wipe and (len(all_trakt_ids) > 0)
-        ):
-            # sends the remove from list request
-            self.post_trakt(
+        self.deleted = {
+            listed[position]["trakt"]: listed[position] for position in extra
+        }
+        self.corrections = [
+            [
+                arr_ids[arr_position],
+                listed[position]["trakt"],
+                listed[position].get(idtag),
+            ]
+            for arr_position, position in zip(
+                correction_pairs[::2], correction_pairs[1::2]
+            )
+        ] + mismatched
+        return needed_ids, trakt_del, extra_ids
+
+    def over_limit(self, job, needed_ids, extra_ids, planned=0):
+        """checks if the sync would put the list over its item limit"""
+        if self.list_limit is None:
+            return False
+        return (
+            (len(self.list_len) + planned + len(needed_ids) - len(extra_ids))
+            > self.list_limit
+        ) or (job.wipe and (planned + len(needed_ids) > self.list_limit))
+
+    def deleted_items(self, media_type, arr_data, idtag, extra_ids, deleted=None):
+        """
+        builds the report of what was deleted, titles come from the arr
+        if it's still there, otherwise from trakt's json (no titles at all
+        unless report_titles, deleted defaults to the last del_from_list's
+        trakt id -> ids)
+        """
+        removed = self.deleted if deleted is None else deleted
+        list_type = media_type.rstrip("s")
+        titles = self.title_index() if self.report_titles else {}
+        deleted = []
+        for trakt_id in extra_ids:
+            ids = removed.get(trakt_id, {})
+            title = titles.get((list_type, trakt_id))
+            if ids.get(idtag) is not None:
+                if self.report_titles and ids.get(idtag) in arr_data:
+                    title = arr_data[ids.get(idtag)][3] or title
+                deleted.append(ListItem(idtag.upper(), ids.get(idtag), title))
+            elif ids.get("imdb") is not None:
+                deleted.append(ListItem("IMDB", ids.get("imdb"), title))
+            else:
+                deleted.append(ListItem("TRAKT", trakt_id, title))
+        return deleted
+
+    def title_index(self):
+        """(type, trakt id) -> title of the list's items, built once per list"""
+        if self.titles is None:
+            self.titles = {}
+            for item in self.json:
+                media = item.get(item.get("type"), {})
+                self.titles[
+                    (item.get("type"), media.get("ids", {}).get("trakt"))
+                ] = media.get("title")
+        return self.titles
+
+    def chunk_json(self, post_json):
+        """splits a {type: [items]} json into chunk_size sized pieces (at least one)"""
+        longest = max((len(items) for items in post_json.values()), default=0)
+        return [
+            {
+                key: items[start : start + self.chunk_size]
+                for key, items in post_json.items()
+                if items[start : start + self.chunk_size]
+            }
+            for start in range(0, longest, self.chunk_size)
+        ] or [{key: [] for key in post_json}]
+
+    def plan_ops(self, trakt_del, trakt_add):
+        """lays out every post this sync needs, in the order they need to happen"""
+        ops = []
+        if not self.list_exists:
+            ops.append(
+                {
+                    "op": "create",
+                    "path": "lists",
+                    "body": {
+                        "name": self.list,
+                        "description": "Created using retraktarr "
+                        "(https://github.com/zakkarry/retraktarr)",
+                        "privacy": self.list_privacy,
+                        "allow_comments": False,
+                    },
+                }
+            )
+        if trakt_del is not None:
+            ops.extend(
+                {
+                    "op": "remove",
+                    "path": f"lists/{self.list_ref}/items/remove",
+                    "body": chunk,
+                }
+                for chunk in self.chunk_json(trakt_del)
+            )
+        # nothing to add means nothing to send (and no list activity to undo
+        # the next run's shortcut)
+        if any(trakt_add.values()):
+            ops.extend(
+                {
+                    "op": "add",
+                    "path": f"lists/{self.list_ref}/items",
+                    "body": chunk,
+                }
+                for chunk in self.chunk_json(trakt_add)
+            )
+        return ops
+
+    def run_journal(self, journal, media_type, resumed=False, title=None):
+        """
+        sends every unconfirmed operation in the journal, confirming each one
+        (resumed: the journal is an interrupted run's, its create may have gone
+        through; title names added items for the snapshot, see ListSnapshot.apply)
+        """
+        results = []
+        for op in journal.pending():
+            if op["op"] == "create":
+                list_info = self.create_list(media_type, op["body"], resumed)
+                journal.confirm(op)
+                self.list_exists = True
+                if self.snapshot is not None:
+                    self.snapshot.apply("create", op["body"], list_info)
+                results.append(("create", None))
+                continue
+            # (the list's id may only be known since the ops were journaled)
+            response = self.post_trakt(
                 self.list,
-                f"lists/{self.normalize_trakt(self.list)}/items/remove",
-                json.dumps(trakt_del),
-                args,
+                self.list_path(op["path"]),
+                op["body"],
                 media_type,
-                timeout=60,
+                items=op_items(op),
             )
+            journal.confirm(op)
+            self.latency.observe(op_items(op), self.last_post_seconds)
+            if self.snapshot is not None:
+                self.snapshot.apply(op["op"], op["body"], response.json(), title)
+            results.append((op["op"], response))
+        if results and self.snapshot is not None:
+            self.snapshot.save()
+        if results:
+            self.latency.save()
+        return results
 
-            # if not a wipe, display what was deleted...dont flood if wiping :P
-            if not args.wipe:
-                print(
-                    f"Number of Deleted {media_type.title()}:  "
-                    f"{len(extra_ids) + len(filtered_extra_imdb_ids)}"
-                )
-
-                # iterate through extra ids (tvdb/tmdb)
-                # display the idname, the title, and the id itself
-                for extra_id in extra_ids:
-                    # uses the arr's json structure to display info
-                    if extra_id in arr_data:
-                        print(
-                            f"        {idtag.upper()}: "
-                            f"{arr_data.get(extra_id, [None])[3]} - {extra_id}"
-                        )
-                        continue
+    def check_plan(self, list_plan, media_type):
+        """
+        makes sure the list is still how it was when the plan was made
+        (raises a TraktError if it isn't) and gets ready to send the plan
+        """
+        self.list = list_plan["list"]
+        self.list_privacy = list_plan["privacy"]
+        if SyncJournal(self.state, self.user, self.list).load():
+            raise TraktError(
+                f"Trakt.tv Error: ({self.list}) has operations pending from an "
+                "interrupted run, sync it and plan it again."
+            )
+        self.snapshot = (
+            ListSnapshot(self.state, self.user, self.list).load()
+            if self.use_snapshot
+            else None
+        )
+        response = (
+            404
+            if self.find_list(media_type) is None
+            else self.get_trakt(
+                f"users/{self.normalize_trakt(self.user)}/lists/{self.list_ref}",
+                media_type,
+            )
+        )
+        list_info = {} if response == 404 else response.json()
+        if (response != 404) != list_plan["list_exists"] or (
+            list_plan["list_exists"]
+            and (
+                list_info.get("item_count") != list_plan["item_count"]
+                or list_plan["updated_at"] is not None
+                and list_info.get("updated_at") != list_plan["updated_at"]
+            )
+        ):
+            raise TraktError(
+                f"Trakt.tv Error: ({self.list}) changed since it was planned, "
+                "plan it again."
+            )
+        if self.snapshot is not None and not self.snapshot.matches(list_info):
+            # the plan can't bring a stale snapshot up to date, refetch next run
+            self.snapshot = None
+        self.list_exists = list_plan["list_exists"]
+        self.list_len = [None] * list_plan["item_count"]
+        self.json = list_plan["removed_items"]
+        self.titles = None
+        self.resumed = 0
+        self.resumed_added = {}
 
-                    # if it can't grab the data from arr, it was deleted from the arr
-                    # it will search trakt's json (slower) for the titles
-                    for data in self.json:
-                        if data[media_type.rstrip("s")]["ids"].get(idtag) == extra_id:
-                            print(
-                                f"        {idtag.upper()}: "
-                                f"{data[media_type.rstrip('s')].get('title')} - {extra_id}"
-                            )
-                            break
-
-                # same as above, but for imdb, but missing tvdb/tmdb on trakt
-                # loops through filtered extra imdb's copy, removing as it finds matches,
-                # so it doesnt double display since the data might be in both arr and trakt
-                arr_data_items = arr_data.items()
-                for item in filtered_extra_imdb_ids.copy():
-                    for value in arr_data_items:
-                        if item == value[1][0]:
-                            print(f"        IMDB: {value[1][3]} - {value[1][0]}")
-                            filtered_extra_imdb_ids.remove(item)
-                            break
-                    if item in filtered_extra_imdb_ids:
-                        for data in self.json:
-                            imdbid = data[media_type.rstrip("s")]["ids"].get("imdb")
-                            if imdbid == item:
-                                print(
-                                    f"        IMDB: {data[media_type.rstrip('s')].get('title')}"
-                                    f" - {imdbid}"
-                                )
-                                break
-        return needed_ids
+    def resume_journal(self, media_type):
+        """
+        resumes the pending operations of an interrupted run on this list
+        (counting what their adds added in resumed_added), returns how many
+        operations were resumed
+        """
+        journal = SyncJournal(self.state, self.user, self.list)
+        pending = journal.load()
+        if not pending:
+            return 0
+        logger.info(
+            f"Resuming {len(pending)} pending operation(s) on ({self.list}) "
+            "from an interrupted run..."
+        )
+        for op, response in self.run_journal(journal, media_type, resumed=True):
+            if op != "add":
+                continue
+            for key, count in response.json().get("added", {}).items():
+                self.resumed_added[key] = self.resumed_added.get(key, 0) + count
+        return len(pending)
 
-    def add_to_list(
+    def plan_change(
         self,
-        args,
+        job,
         media_type,
         arr_data,
-        trakt_ids,
         idtag,
-        trakt_imdb_ids,
         arr_ids,
-        arr_imdb,
         all_trakt_ids,
+        result,
+        planned=0,
+        diffed=None,
     ):
         """
-        parse out and compares arr lists with trakt, then runs
-        del_from_list and updates/adds to the list
+        parse out and compares an arr list with trakt (runs del_from_list),
+        returns the change (removal/add json and what's needed to report it).
+        planned is the item count change other jobs on the list already planned,
+        diffed an already started start_diff's result
         """
+        started = time.perf_counter()
 
         # blank type for trakt_add - trakt_add = {media_type: []}
-        needed_ids = self.del_from_list(
-            args,
-            media_type,
-            arr_data,
-            trakt_ids,
-            idtag,
-            trakt_imdb_ids,
-            arr_ids,
-            arr_imdb,
-            all_trakt_ids,
+        needed_ids, trakt_del, extra_ids = self.del_from_list(
+            job, media_type, arr_data, idtag, arr_ids, all_trakt_ids, planned, diffed
         )
 
+        # leave out ids trakt couldn't find recently (until their ttl runs out)
+        not_found_cache = None
+        skipped_ids = set()
+        if self.not_found_ttl:
+            not_found_cache = NotFoundCache(
+                self.state, self.user, self.list, idtag, ttl=self.not_found_ttl
+            ).load()
+            needed_ids, skipped_ids = not_found_cache.skip(needed_ids, arr_data)
+
         # build the add to list json, if imdb is not available just use tmdb/tvdb
-        trakt_add = {
-            media_type: [
-                (
-                    {"ids": {idtag: item, "imdb": arr_data.get(item, [None])[0]}}
-                    if arr_data.get(item, [None])[0] is not None
-                    else {"ids": {idtag: item}}
-                )
-                for item in needed_ids
-            ]
+        # and if the cross reference knows the trakt id, send that too
+        # (monitored titles first, they go out first if a deadline cuts the run short)
+        trakt_add = {media_type: []}
+        for item in sorted(needed_ids, key=lambda item: not arr_data.get(item)[1]):
+            ids = {idtag: item}
+            if arr_data.get(item, [None])[0] is not None:
+                ids["imdb"] = arr_data.get(item, [None])[0]
+            trakt_id = self.xref.trakt_id(
+                media_type.rstrip("s"), idtag, item, ids.get("imdb")
+            )
+            if trakt_id is not None:
+                ids["trakt"] = trakt_id
+            trakt_add[media_type].append({"ids": ids})
+        result.timings["diff"] = time.perf_counter() - started
+
+        return {
+            "job": job,
+            "media_type": media_type,
+            "arr_data": arr_data,
+            "idtag": idtag,
+            "all_trakt_ids": all_trakt_ids,
+            "result": result,
+            "needed_ids": needed_ids,
+            "skipped_ids": skipped_ids,
+            "extra_ids": extra_ids,
+            "deleted": self.deleted,
+            "corrections": self.corrections,
+            "not_found_cache": not_found_cache,
+            "trakt_del": trakt_del,
+            "trakt_add": trakt_add,
         }
-        # sends the add to list request
-        response = self.post_trakt(
-            self.list,
-            f"lists/{self.normalize_trakt(self.list)}/items",
-            json.dumps(trakt_add),
-            args,
-            media_type,
-            timeout=60,
+
+    @staticmethod
+    def merge_json(bodies):
+        """
+        merges {type: [items]} jsons into one (trakt takes movies and shows in
+        the same body), items several bodies share (wipes) are only sent once
+        """
+        bodies = list(bodies)
+        if len(bodies) == 1:
+            return bodies[0]
+        merged = {}
+        seen = set()
+        for body in bodies:
+            for key, items in body.items():
+                merged.setdefault(key, [])
+                for item in items:
+                    item_ids = (key, tuple(sorted(item["ids"].items())))
+                    if item_ids not in seen:
+                        seen.add(item_ids)
+                        merged[key].append(item)
+        return merged
+
+    def send_changes(self, changes):
+        """
+        journals and sends the removes/adds of one or more changes to the
+        list in chunks, as combined posts. returns the (op, response) pairs
+        """
+        started = time.perf_counter()
+        removals = [
+            change["trakt_del"] for change in changes if change["trakt_del"] is not None
+        ]
+        trakt_del = self.merge_json(removals) if removals else None
+        trakt_add = self.merge_json(change["trakt_add"] for change in changes)
+
+        # removals go first, then the adds (monitored first), whatever wouldn't
+        # make the deadline is left out, the next run's diff picks it up again
+        ops = self.plan_ops(trakt_del, trakt_add)
+        sent = None
+        if self.deadline is not None:
+            fitted = fit_ops(
+                ops,
+                self.deadline - time.monotonic(),
+                self.latency,
+                1 / self.post_limiter.rate,
+            )
+            # only a cut down run needs to know which items made it
+            if len(fitted) < len(ops) or any(
+                kept is not op for kept, op in zip(fitted, ops)
+            ):
+                sent = {}
+                for op in fitted:
+                    if op["op"] == "create":
+                        continue
+                    for key, items in op["body"].items():
+                        sent.setdefault((op["op"], key), set()).update(
+                            tuple(sorted(item["ids"].items())) for item in items
+                        )
+            ops = fitted
+        for change in changes:
+            change["sent"] = sent
+
+        def title(media_type, ids):
+            # the arr's title of an item added by one of the changes
+            for change in changes:
+                if change["media_type"].rstrip("s") == media_type:
+                    row = change["arr_data"].get(ids.get(change["idtag"]))
+                    if row is not None:
+                        return row[3]
+            return None
+
+        # write the plan down before anything is sent so it can be resumed
+        responses = []
+        if ops:
+            journal = SyncJournal(self.state, self.user, self.list)
+            journal.plan(ops)
+            responses = self.run_journal(journal, changes[0]["media_type"], title=title)
+        for change in changes:
+            change["result"].timings["post"] = time.perf_counter() - started
+        return responses
+
+    def finish_change(self, change, responses):
+        """fills in the change's sync result from the post responses"""
+        job = change["job"]
+        media_type = change["media_type"]
+        arr_data = change["arr_data"]
+        idtag = change["idtag"]
+        result = change["result"]
+
+        # what a deadline left out of the posts is deferred to the next run
+        sent = change.get("sent")
+        if sent is None:
+            removed_ids = set(change["extra_ids"])
+            added_ids = {item["ids"][idtag] for item in change["trakt_add"][media_type]}
+        else:
+            removed_ids = {
+                trakt_id
+                for trakt_id in change["extra_ids"]
+                if (("trakt", trakt_id),) in sent.get(("remove", media_type), set())
+            }
+            added_ids = {
+                item["ids"][idtag]
+                for item in change["trakt_add"][media_type]
+                if tuple(sorted(item["ids"].items()))
+                in sent.get(("add", media_type), set())
+            }
+        result.deferred = (
+            len(change["extra_ids"])
+            - len(removed_ids)
+            + len(change["needed_ids"])
+            - len(added_ids)
         )
 
-        # gets the count for the add results...
-        added_items = response.json()["added"][media_type.lower()]
-        listed_items = response.json()["list"]["item_count"]
-        not_found_items = response.json()["not_found"].get(media_type.lower(), [])
+        if change["trakt_del"] is not None:
+            if job.wipe:
+                result.wiped = len(change["all_trakt_ids"])
+            elif removed_ids:
+                result.removed = self.deleted_items(
+                    media_type, arr_data, idtag, removed_ids, change["deleted"]
+                )
+
+        # gets the count for the add results (summed over every add chunk)...
+        # (the list count comes from the last post, or the list if nothing was sent)
+        not_found_items = []
+        result.listed = len(self.list_len)
+        for op, response in responses:
+            if op == "create":
+                continue
+            result.listed = (
+                response.json().get("list", {}).get("item_count", result.listed)
+            )
+            if op != "add":
+                continue
+            result.added += response.json()["added"].get(media_type.lower(), 0)
+            not_found_items.extend(
+                response.json()["not_found"].get(media_type.lower(), [])
+            )
 
         # sets the state for items that parsing what really wasnt added due to not corresponding ids
         real_not_found_items = []
@@ -528,23 +1188,38 @@ class TraktAPI:
             if idtag_value is not None and idtag_value in arr_data.keys():
                 real_not_found_items.append(idtag_value)
 
-        print(f"Number of {media_type.title()} Added: {added_items}")
+        if change["not_found_cache"] is not None:
+            change["not_found_cache"].record(added_ids, real_not_found_items, arr_data)
+            change["not_found_cache"].save()
 
-        # if real not found is over 0, print the results from the arr_data
-        if len(real_not_found_items) > 0:
-            print(
-                f"Number of {media_type.title()} Not Found: {len(real_not_found_items)}"
+        result.not_found = [
+            ListItem(
+                idtag.upper(),
+                item,
+                arr_data[item][3] if self.report_titles else None,
             )
-            for real_not_found_item in real_not_found_items:
-                print(
-                    f"        {idtag.upper()}: "
-                    f"{arr_data.get(real_not_found_item, [None])[3]} - {real_not_found_item}"
-                )
+            for item in real_not_found_items
+        ]
+        result.skipped = len(change["skipped_ids"])
+        return result
 
-        # if real not found is 0, finish up
-        else:
-            print(f"Number of {media_type.title()} Not Found: 0")
-        print(f"Number of {media_type.title()} Listed: {listed_items}")
+    def add_to_list(
+        self, job, media_type, arr_data, idtag, arr_ids, all_trakt_ids, result
+    ):
+        """
+        parse out and compares arr lists with trakt, runs del_from_list,
+        then journals and sends the removes/adds to the list in chunks
+        fills in and returns the sync result
+        """
+        change = self.plan_change(
+            job, media_type, arr_data, idtag, arr_ids, all_trakt_ids, result
+        )
+        responses = self.send_changes([change])
+        self.finish_change(change, responses)
+        self.xref.save()
+        return result
 
-        # close the requests session
+    def close(self):
+        """closes the requests session (and keeps what was learned about timeouts)"""
+        self.timeouts.save()
         self.trakt_session.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" compact library backups for restoring radarr/sonarr """
+import json
+import os
+import time
+
+from retraktarr.exceptions import ConfigurationError
+
+BACKUP_VERSION = 1
+
+
+def write_backup(file_path, libraries):
+    """writes arr -> backup entries (ArrAPI.get_backup) to a backup file"""
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as backup_file:
+            json.dump(
+                {
+                    "version": BACKUP_VERSION,
+                    "created": int(time.time()),
+                    "libraries": libraries,
+                },
+                backup_file,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, file_path)
+    except OSError as error:
+        raise ConfigurationError(
+            f"Error: Could not write backup file '{file_path}': {error}"
+        ) from error
+
+
+def read_backup(file_path):
+    """reads a backup file, returns its arr -> backup entries"""
+    try:
+        with open(file_path, encoding="utf-8") as backup_file:
+            data = json.load(backup_file)
+    except (OSError, ValueError) as error:
+        raise ConfigurationError(
+            f"Error: Could not read backup file '{file_path}': {error}"
+        ) from error
+    if not isinstance(data, dict) or data.get("version") != BACKUP_VERSION:
+        raise ConfigurationError(
+            f"Error: '{file_path}' is not a retraktarr backup file."
+        )
+    return data.get("libraries", {})
+
+
+def list_entries(items, media_type, idtag):
+    """
+    turns trakt list items of the media type (movies/shows) into backup
+    entries, returns them and the items without an id the arr can add by
+    """
+    list_type = media_type.rstrip("s")
+    entries = []
+    unusable = []
+    for item in items:
+        if item.get("type") != list_type:
+            continue
+        ids = item[list_type].get("ids", {})
+        if ids.get(idtag) is None:
+            unusable.append(item[list_type])
+            continue
+        entries.append(
+            {
+                idtag: ids.get(idtag),
+                "imdb": ids.get("imdb"),
+                "title": item[list_type].get("title"),
+            }
+        )
+    return entries, unusable
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+""" persistent caches kept between runs (ids trakt can't find, etc) """
+import threading
+import time
+
+DAY = 86400
+
+
+class NotFoundCache:
+    """
+    ids trakt returned as not_found for a list (per id type), so they
+    aren't resent every run. entries are re-probed once their ttl runs out
+    (the ttl doubles every time trakt still can't find them, up to max_ttl)
+    or as soon as the arr record changes (new imdb id)
+    """
+
+    def __init__(self, store, user, list_name, idtag, ttl=7 * DAY, max_ttl=60 * DAY):
+        self.store = store
+        self.name = store.key("notfound", user, list_name, idtag)
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        # id -> [expires, ttl, imdb id when it wasn't found]
+        self.entries = {}
+        self.changed = False
+
+    def load(self):
+        """loads the cache from the state directory"""
+        self.entries = {
+            int(arr_id) if arr_id.isdigit() else arr_id: entry
+            for arr_id, entry in self.store.load(self.name, {}).items()
+        }
+        return self
+
+    def save(self):
+        """writes the cache back if anything changed"""
+        if not self.changed:
+            return
+        self.store.save(
+            self.name, {str(arr_id): entry for arr_id, entry in self.entries.items()}
+        )
+        self.changed = False
+
+    def skip(self, needed_ids, arr_data):
+        """
+        splits the needed ids into (to send, cached not found), dropping
+        expired entries, entries whose arr record changed, and entries
+        no longer in the arr at all
+        """
+        now = time.time()
+        for arr_id in [arr_id for arr_id in self.entries if arr_id not in arr_data]:
+            del self.entries[arr_id]
+            self.changed = True
+
+        to_send, skipped = set(), set()
+        for arr_id in needed_ids:
+            entry = self.entries.get(arr_id)
+            if entry is not None and entry[2] != arr_data.get(arr_id, [None])[0]:
+                # the arr record changed, start over with a fresh entry
+                del self.entries[arr_id]
+                self.changed = True
+                entry = None
+            if entry is None:
+                to_send.add(arr_id)
+            elif entry[0] <= now:
+                # time to re-probe, keep the entry around so the ttl can back off
+                to_send.add(arr_id)
+            else:
+                skipped.add(arr_id)
+        return to_send, skipped
+
+    def record(self, sent_ids, not_found_ids, arr_data):
+        """updates the cache with the results of an add request"""
+        not_found_ids = set(not_found_ids)
+        now = time.time()
+        for arr_id in sent_ids:
+            entry = self.entries.get(arr_id)
+            if arr_id in not_found_ids:
+                ttl = self.ttl if entry is None else min(entry[1] * 2, self.max_ttl)
+                self.entries[arr_id] = [now + ttl, ttl, arr_data.get(arr_id, [None])[0]]
+                self.changed = True
+            elif entry is not None:
+                # trakt found it this time
+                del self.entries[arr_id]
+                self.changed = True
+
+
+class IDCrossReference:
+    """
+    maps external ids (tmdb/tvdb/imdb) to trakt ids, learned from every
+    list fetch and from id lookups, so lists can be diffed on trakt ids
+    """
+
+    ID_TYPES = ("tmdb", "tvdb", "imdb")
+
+    def __init__(self, store):
+        self.store = store
+        self.name = "xref"
+        # media type -> trakt id -> [tmdb, tvdb, imdb]
+        self.records = {"movie": {}, "show": {}}
+        # media type -> "idtype:id" -> trakt id
+        self.index = {"movie": {}, "show": {}}
+        self.changed = False
+        # shared by every account's TraktAPI in an engine
+        self.lock = threading.RLock()
+
+    def load(self):
+        """loads the cross reference and rebuilds its indexes"""
+        for media_type, records in self.store.load(self.name, {}).items():
+            for trakt_id, ids in records.items():
+                self.learn(
+                    media_type, dict(zip(self.ID_TYPES, ids), trakt=int(trakt_id))
+                )
+        self.changed = False
+        return self
+
+    def save(self):
+        """writes the cross reference back if anything was learned"""
+        with self.lock:
+            if not self.changed:
+                return
+            self.store.save(
+                self.name,
+                {
+                    media_type: {
+                        str(trakt_id): ids for trakt_id, ids in records.items()
+                    }
+                    for media_type, records in self.records.items()
+                },
+            )
+            self.changed = False
+
+    def learn(self, media_type, ids):
+        """records a trakt ids object (as returned in lists/searches)"""
+        trakt_id = ids.get("trakt")
+        if trakt_id is None or media_type not in self.records:
+            return
+        record = [ids.get(id_type) for id_type in self.ID_TYPES]
+        with self.lock:
+            old_record = self.records[media_type].get(trakt_id)
+            if old_record == record:
+                return
+            # drop index entries for ids trakt has since corrected
+            for id_type, value in zip(self.ID_TYPES, old_record or []):
+                if self.index[media_type].get(f"{id_type}:{value}") == trakt_id:
+                    del self.index[media_type][f"{id_type}:{value}"]
+            self.records[media_type][trakt_id] = record
+            for id_type, value in zip(self.ID_TYPES, record):
+                if value is not None:
+                    self.index[media_type][f"{id_type}:{value}"] = trakt_id
+            self.changed = True
+
+    def learn_list(self, items):
+        """records every item of a trakt list response"""
+        for item in items:
+            media_type = item.get("type")
+            self.learn(media_type, item.get(media_type, {}).get("ids", {}))
+
+    def trakt_id(self, media_type, idtag, arr_id, imdb_id, listed=None):
+        """
+        resolves an arr item to its trakt id (None if unknown). when its imdb
+        and tmdb/tvdb ids point at different titles the imdb one wins, unless
+        only the tmdb/tvdb one is on the list (listed, a set of trakt ids),
+        then that match is kept so the listed item isn't removed and re-added
+        """
+        index = self.index.get(media_type, {})
+        trakt_id = index.get(f"{idtag}:{arr_id}")
+        imdb_match = index.get(f"imdb:{imdb_id}") if imdb_id is not None else None
+        if imdb_match is None or imdb_match == trakt_id:
+            return trakt_id
+        if (
+            trakt_id is not None
+            and listed is not None
+            and trakt_id in listed
+            and imdb_match not in listed
+        ):
+            return trakt_id
+        return imdb_match
+
+    def imdb_id(self, media_type, trakt_id):
+        """the imdb id trakt has for a trakt id (None if unknown)"""
+        return (self.records.get(media_type, {}).get(trakt_id) or [None] * 3)[2]
+
+
+class ListSnapshot:
+    """
+    local copy of a trakt list's items, kept up to date from the results of
+    our own add/remove posts. it's only trusted while the list's updated_at
+    and item_count still match what our last post left behind, and while
+    every item in it has a trakt id (new titles are added by tmdb/tvdb/imdb,
+    so the next run fetches the list once to learn their trakt ids).
+    activity is the account's sync/last_activities lists timestamp the
+    snapshot was last checked at, while it hasn't moved the list can't have either
+    """
+
+    def __init__(self, store, user, list_name):
+        self.store = store
+        self.name = store.key("snapshot", user, list_name)
+        self.items = []
+        self.updated_at = None
+        self.item_count = None
+        self.complete = False
+        self.activity = None
+
+    def load(self):
+        """loads the snapshot from the state directory"""
+        data = self.store.load(self.name, {})
+        self.items = data.get("items", [])
+        self.updated_at = data.get("updated_at")
+        self.item_count = data.get("item_count")
+        self.complete = data.get("complete", False)
+        self.activity = data.get("activity")
+        return self
+
+    def save(self):
+        """writes the snapshot back"""
+        self.store.save(
+            self.name,
+            {
+                "updated_at": self.updated_at,
+                "item_count": self.item_count,
+                "complete": self.complete,
+                "activity": self.activity,
+                "items": self.items,
+            },
+        )
+
+    def matches(self, list_info):
+        """checks the snapshot against the list's metadata (users/{user}/lists/{list})"""
+        return (
+            self.complete
+            and self.updated_at is not None
+            and list_info.get("updated_at") == self.updated_at
+            and list_info.get("item_count") == self.item_count == len(self.items)
+        )
+
+    def unchanged(self, activity):
+        """checks the snapshot against the account's last list activity"""
+        return (
+            self.complete
+            and self.updated_at is not None
+            and activity is not None
+            and self.activity == activity
+            and self.item_count == len(self.items)
+        )
+
+    def replace(self, items, list_info):
+        """takes a freshly fetched list (only the parts retraktarr uses)"""
+        self.items = [
+            {
+                "type": item.get("type"),
+                item.get("type"): {
+                    "title": item.get(item.get("type"), {}).get("title"),
+                    "ids": item.get(item.get("type"), {}).get("ids", {}),
+                },
+            }
+            for item in items
+            if item.get("type") in ("movie", "show")
+        ]
+        self.complete = len(self.items) == len(items)
+        self.set_list_info(list_info)
+
+    def set_list_info(self, list_info):
+        """records the list's updated_at/item_count (from metadata or a post result)"""
+        self.updated_at = list_info.get("updated_at")
+        self.item_count = list_info.get("item_count")
+
+    def apply(self, op, body, response_json, title=None):
+        """
+        applies a confirmed create/remove/add post to the snapshot. title(type,
+        ids) gives an added item's title, the list is refetched next run if
+        one isn't known (a resumed post), so reports can still name its items
+        """
+        # our own post moved the account's activity, check the list next run
+        self.activity = None
+        if op == "create":
+            self.items = []
+            self.complete = True
+            self.set_list_info(
+                {"updated_at": response_json.get("updated_at"), "item_count": 0}
+            )
+            return
+        for key, sent in body.items():
+            media_type = key.rstrip("s")
+            if media_type not in ("movie", "show"):
+                continue
+            not_found = response_json.get("not_found", {}).get(key, [])
+            if op == "remove":
+                removed = {
+                    item["ids"].get("trakt")
+                    for item in sent
+                    if item not in not_found or item["ids"].get("trakt") is None
+                }
+                self.items = [
+                    item
+                    for item in self.items
+                    if item["type"] != media_type
+                    or item[media_type]["ids"].get("trakt") not in removed
+                ]
+                continue
+            listed = {
+                item[media_type]["ids"].get("trakt")
+                for item in self.items
+                if item["type"] == media_type
+            }
+            for item in sent:
+                if item in not_found or item["ids"].get("trakt") in listed:
+                    continue
+                name = title(media_type, item["ids"]) if title is not None else None
+                if item["ids"].get("trakt") is None or name is None:
+                    self.complete = False
+                self.items.append(
+                    {
+                        "type": media_type,
+                        media_type: {"title": name, "ids": item["ids"]},
+                    }
+                )
+        self.set_list_info(response_json.get("list", {}))
+
+
+class ListRegistry:
+    """
+    the account's lists (users/{user}/lists) by trakt id: name, slug,
+    privacy and item count. lists are addressed by their trakt id instead
+    of a slug guessed from the list name, and a list that isn't there is
+    created before anything is sent to it. refetched once older than ttl
+    """
+
+    def __init__(self, store, user, ttl=DAY):
+        self.store = store
+        self.name = store.key("lists", user)
+        self.ttl = ttl
+        # trakt id (str) -> {"name", "slug", "privacy", "item_count"}
+        self.lists = {}
+        self.fetched = 0
+
+    def load(self):
+        """loads the registry from the state directory"""
+        data = self.store.load(self.name, {})
+        self.lists = data.get("lists", {})
+        self.fetched = data.get("fetched", 0)
+        return self
+
+    def save(self):
+        """writes the registry back"""
+        self.store.save(self.name, {"fetched": self.fetched, "lists": self.lists})
+
+    def age(self):
+        """seconds since the lists were fetched"""
+        return time.time() - self.fetched
+
+    def replace(self, lists):
+        """takes a freshly fetched users/{user}/lists"""
+        self.lists = {}
+        for list_info in lists:
+            self.add(list_info)
+        self.fetched = time.time()
+
+    def add(self, list_info):
+        """records a list (from users/{user}/lists or a list creation's response)"""
+        trakt_id = list_info.get("ids", {}).get("trakt")
+        if trakt_id is not None:
+            self.lists[str(trakt_id)] = {
+                "name": list_info.get("name"),
+                "slug": list_info.get("ids", {}).get("slug"),
+                "privacy": list_info.get("privacy"),
+                "item_count": list_info.get("item_count", 0),
+            }
+        return trakt_id
+
+    def forget(self, trakt_id):
+        """drops a list trakt no longer has"""
+        self.lists.pop(str(trakt_id), None)
+
+    def find(self, list_name, slug=None):
+        """
+        the trakt id of the list called list_name (or with that slug, the
+        slug it would be given), None if the account has no such list. of
+        duplicates (a create that went through twice) the fullest one is used
+        """
+        for matches in (
+            lambda entry: entry["name"] == list_name,
+            lambda entry: entry["slug"] in (list_name, slug),
+            lambda entry: (entry["name"] or "").casefold() == list_name.casefold(),
+            lambda entry: slug is not None
+            and (entry["slug"] or "").casefold() == slug.casefold(),
+        ):
+            found = [
+                (entry.get("item_count") or 0, -int(trakt_id))
+                for trakt_id, entry in self.lists.items()
+                if matches(entry)
+            ]
+            if found:
+                return -max(found)[1]
+        return None
+
+    def entry(self, trakt_id):
+        """a list's name/slug/privacy/item count"""
+        return self.lists.get(str(trakt_id), {})
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+""" record/replay of arr and trakt http traffic, for reproducing runs offline """
+import gzip
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from retraktarr.exceptions import ConfigurationError
+
+CASSETTE_VERSION = 1
+
+# the parts of arr library items (movie/series) retraktarr reads, the rest
+# (file paths, overviews, images...) is dropped
+ARR_FIELDS = {
+    "id",
+    "tmdbId",
+    "tvdbId",
+    "imdbId",
+    "title",
+    "monitored",
+    "qualityProfileId",
+    "tags",
+    "hasFile",
+    "genres",
+    "rootFolderPath",
+    "minimumAvailability",
+    "seasonFolder",
+    "seriesType",
+}
+
+# the parts of trakt list objects retraktarr reads, the rest (the owner's
+# user object, description...) is dropped
+LIST_FIELDS = {"name", "privacy", "item_count", "updated_at", "ids"}
+
+
+def redact_url(url):
+    """
+    the request key of a url: arr hosts are hashed and api keys dropped,
+    trakt usernames are replaced so a cassette doesn't give the account away
+    """
+    parsed = urlparse(url)
+    query = urlencode(
+        [(key, value) for key, value in parse_qsl(parsed.query) if key != "apikey"]
+    )
+    if parsed.hostname == "api.trakt.tv":
+        path = re.sub(r"^/users/[^/]+(?=/)", "/users/-", parsed.path)
+        return f"trakt:{path}" + (f"?{query}" if query else "")
+    host = hashlib.sha1(parsed.netloc.split("@")[-1].encode()).hexdigest()[:8]
+    path = parsed.path.split("/api/v3/")[-1]
+    return f"arr-{host}:{path}" + (f"?{query}" if query else "")
+
+
+def redact_list(list_info):
+    """a trakt list object without its owner (only its own ids are kept)"""
+    list_info = {
+        field: value for field, value in list_info.items() if field in LIST_FIELDS
+    }
+    if isinstance(list_info.get("ids"), dict):
+        list_info["ids"] = {
+            field: value
+            for field, value in list_info["ids"].items()
+            if field in ("trakt", "slug")
+        }
+    return list_info
+
+
+def redact_content(key, content):
+    """keeps only what retraktarr reads from responses that carry personal data"""
+    if key == "trakt:/users/settings" and isinstance(content, dict):
+        return {"limits": content.get("limits", {})}
+    if re.match(r"trakt:/users/-/lists(/[^/]+)?$", key):
+        if isinstance(content, dict):
+            return redact_list(content)
+        if isinstance(content, list):
+            return [
+                redact_list(item) if isinstance(item, dict) else item
+                for item in content
+            ]
+    if re.match(r"arr-[0-9a-f]+:(movie|series)$", key) and isinstance(content, list):
+        return [
+            {field: value for field, value in item.items() if field in ARR_FIELDS}
+            if isinstance(item, dict)
+            else item
+            for item in content
+        ]
+    return content
+
+
+class Cassette:
+    """
+    records every request made through the sessions it's mounted on (with
+    status, body and latency) to a compact redacted file, or replays such a
+    file offline. replays answer requests in recorded order per url (and
+    body), at the recorded latency or none at all
+    """
+
+    def __init__(self, file_path, mode="record", latency="recorded"):
+        self.file_path = file_path
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.interactions = []
+        if mode == "replay":
+            self.load()
+
+    def load(self):
+        """reads a cassette for replaying"""
+        try:
+            opener = gzip.open if self.file_path.endswith(".gz") else open
+            with opener(self.file_path, "rt", encoding="utf-8") as cassette_file:
+                data = json.load(cassette_file)
+        except (OSError, ValueError) as error:
+            raise ConfigurationError(
+                f"Error: Could not read cassette '{self.file_path}': {error}"
+            ) from error
+        if not isinstance(data, dict) or data.get("version") != CASSETTE_VERSION:
+            raise ConfigurationError(
+                f"Error: '{self.file_path}' is not a retraktarr cassette."
+            )
+        self.interactions = data.get("interactions", [])
+        for interaction in self.interactions:
+            interaction["used"] = False
+
+    def save(self):
+        """writes the recorded interactions (gzipped if the name ends in .gz)"""
+        if self.mode != "record":
+            return
+        try:
+            opener = gzip.open if self.file_path.endswith(".gz") else open
+            with opener(self.file_path, "wt", encoding="utf-8") as cassette_file:
+                json.dump(
+                    {"version": CASSETTE_VERSION, "interactions": self.interactions},
+                    cassette_file,
+                    separators=(",", ":"),
+                )
+        except OSError as error:
+            raise ConfigurationError(
+                f"Error: Could not write cassette '{self.file_path}': {error}"
+            ) from error
+
+    def mount(self, session, account=None):
+        """
+        routes a requests session through the cassette, account labels its
+        interactions (trakt urls don't tell accounts apart, and several
+        accounts' requests interleave on their own threads)
+        """
+        adapter = CassetteAdapter(self, account)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    @staticmethod
+    def request_body(request):
+        """the request body as text (posts are json)"""
+        body = request.body
+        if isinstance(body, bytes):
+            return body.decode("utf-8", "replace")
+        return body or ""
+
+    def record(self, request, response, seconds, account=None):
+        """stores a request and its response"""
+        key = redact_url(request.url)
+        try:
+            content = redact_content(key, response.json())
+            is_json = True
+        except ValueError:
+            content = response.text
+            is_json = False
+        interaction = {
+            "account": account,
+            "method": request.method,
+            "url": key,
+            "body": self.request_body(request),
+            "status": response.status_code,
+            "headers": {
+                name: response.headers[name]
+                for name in ("Retry-After", "Content-Type")
+                if name in response.headers
+            },
+            "json": is_json,
+            "content": content,
+            "seconds": round(seconds, 4),
+        }
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def replay(self, request, account=None):
+        """answers a request from the cassette (recorded for the same account)"""
+        key = redact_url(request.url)
+        body = self.request_body(request)
+        with self.lock:
+            candidates = [
+                interaction
+                for interaction in self.interactions
+                if not interaction["used"]
+                and interaction["method"] == request.method
+                and interaction["url"] == key
+                and interaction.get("account") in (None, account)
+            ]
+            # the same body if it was recorded, otherwise the next one in order
+            match = next(
+                (item for item in candidates if item["body"] == body),
+                candidates[0] if candidates else None,
+            )
+            if match is None:
+                raise requests.exceptions.ConnectionError(
+                    f"{request.method} {key} is not in the cassette"
+                )
+            match["used"] = True
+        if self.latency == "recorded":
+            time.sleep(match["seconds"])
+        response = requests.Response()
+        response.status_code = match["status"]
+        response.headers = CaseInsensitiveDict(match["headers"])
+        content = (
+            json.dumps(match["content"]) if match["json"] else match["content"]
+        ).encode("utf-8")
+        # a fully read response, streaming (iter_content) replays the same bytes
+        response._content = content
+        response._content_consumed = True
+        response.raw = io.BytesIO(content)
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        try:
+            response.reason = HTTPStatus(match["status"]).phrase
+        except ValueError:
+            response.reason = ""
+        return response
+
+
+class CassetteAdapter(HTTPAdapter):
+    """transport adapter recording to/replaying from a cassette"""
+
+    def __init__(self, cassette, account=None):
+        super().__init__()
+        self.cassette = cassette
+        self.account = account
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == "replay":
+            return self.cassette.replay(request, self.account)
+        started = time.perf_counter()
+        response = super().send(request, **kwargs)
+        self.cassette.record(
+            request, response, time.perf_counter() - started, self.account
+        )
+        return response
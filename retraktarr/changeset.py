@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+""" serialized change sets, planned syncs that can be applied later """
+import json
+import os
+import time
+from dataclasses import asdict, replace
+
+from retraktarr.cache import NotFoundCache
+from retraktarr.exceptions import ConfigurationError
+from retraktarr.models import SyncJob, SyncResult
+from retraktarr.shard import base_name
+
+CHANGESET_VERSION = 1
+
+
+def list_plan(trakt_api, changes):
+    """
+    serializes the planned changes to trakt_api's current list: removals,
+    additions, outdated trakt ids, the expected final count against the
+    list limit, and the list state they were planned against
+    """
+    expected = len(trakt_api.list_len)
+    for change in changes:
+        if change["job"].wipe:
+            expected = 0
+    for change in changes:
+        expected += len(change["needed_ids"]) - len(change["extra_ids"])
+    removed = set()
+    for change in changes:
+        removed.update(change["extra_ids"])
+    snapshot = trakt_api.snapshot
+    return {
+        "account": changes[0]["job"].account,
+        "list": trakt_api.list,
+        # the list runs lock while changing it (a shard's base list, like a sync)
+        "run_list": (
+            base_name(trakt_api.list) if changes[0]["job"].shard else trakt_api.list
+        ),
+        "privacy": trakt_api.list_privacy,
+        "list_exists": trakt_api.list_exists,
+        "item_count": len(trakt_api.list_len),
+        "updated_at": (
+            snapshot.updated_at
+            if snapshot is not None and trakt_api.list_exists
+            else None
+        ),
+        "list_limit": trakt_api.list_limit,
+        "expected_count": expected,
+        # the list entries being removed, for reporting their titles
+        "removed_items": [
+            item
+            for item in trakt_api.json
+            if item.get(item.get("type"), {}).get("ids", {}).get("trakt") in removed
+        ],
+        "changes": [change_to_json(change) for change in changes],
+    }
+
+
+def change_to_json(change):
+    """a planned change (TraktAPI.plan_change's) as json, without the arr's secrets"""
+    return {
+        "job": asdict(replace(change["job"], url="", api_key="")),
+        "media_type": change["media_type"],
+        "idtag": change["idtag"],
+        "total": change["result"].total,
+        # only what's needed to report/record the additions
+        "arr_data": [
+            [arr_id, change["arr_data"].get(arr_id)] for arr_id in change["needed_ids"]
+        ],
+        "all_trakt_ids": list(change["all_trakt_ids"]) if change["job"].wipe else [],
+        "needed_ids": list(change["needed_ids"]),
+        "skipped_ids": list(change["skipped_ids"]),
+        "extra_ids": list(change["extra_ids"]),
+        "deleted": [[trakt_id, ids] for trakt_id, ids in change["deleted"].items()],
+        "corrections": change["corrections"],
+        "trakt_del": change["trakt_del"],
+        "trakt_add": change["trakt_add"],
+    }
+
+
+def change_from_json(data, trakt_api):
+    """rebuilds a planned change to send with trakt_api (list already set)"""
+    job = SyncJob(**data["job"])
+    not_found_cache = None
+    if trakt_api.not_found_ttl:
+        not_found_cache = NotFoundCache(
+            trakt_api.state,
+            trakt_api.user,
+            trakt_api.list,
+            data["idtag"],
+            ttl=trakt_api.not_found_ttl,
+        ).load()
+    result = SyncResult(job, data["media_type"])
+    result.total = data["total"]
+    return {
+        "job": job,
+        "media_type": data["media_type"],
+        "arr_data": {arr_id: values for arr_id, values in data["arr_data"]},
+        "idtag": data["idtag"],
+        "all_trakt_ids": data["all_trakt_ids"],
+        "result": result,
+        "needed_ids": set(data["needed_ids"]),
+        "skipped_ids": set(data["skipped_ids"]),
+        "extra_ids": set(data["extra_ids"]),
+        "deleted": {trakt_id: ids for trakt_id, ids in data["deleted"]},
+        "corrections": data["corrections"],
+        "not_found_cache": not_found_cache,
+        "trakt_del": data["trakt_del"],
+        "trakt_add": data["trakt_add"],
+    }
+
+
+def write_changeset(file_path, plans):
+    """writes list plans (SyncEngine.plan's) to a change set file"""
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as changeset_file:
+            json.dump(
+                {
+                    "version": CHANGESET_VERSION,
+                    "created": int(time.time()),
+                    "lists": plans,
+                },
+                changeset_file,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, file_path)
+    except OSError as error:
+        raise ConfigurationError(
+            f"Error: Could not write change set '{file_path}': {error}"
+        ) from error
+
+
+def read_changeset(file_path):
+    """reads a change set file, returns its list plans"""
+    try:
+        with open(file_path, encoding="utf-8") as changeset_file:
+            data = json.load(changeset_file)
+    except (OSError, ValueError) as error:
+        raise ConfigurationError(
+            f"Error: Could not read change set '{file_path}': {error}"
+        ) from error
+    if not isinstance(data, dict) or data.get("version") != CHANGESET_VERSION:
+        raise ConfigurationError(
+            f"Error: '{file_path}' is not a retraktarr change set."
+        )
+    return data.get("lists", [])
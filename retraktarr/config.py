@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 """ validation and config generation - pretty standard shit """
 import configparser
+import logging
 import os
 import re
-import sys
+import threading
 
 import requests
 
+from retraktarr.exceptions import ConfigurationError, TraktAuthError
+from retraktarr.models import SyncJob
+from retraktarr.runlock import FileLock
+
+logger = logging.getLogger(__name__)
+
 
 class Configuration:
     """configuration file class"""
@@ -14,10 +21,9 @@ class Configuration:
     def __init__(self, config_file):
         self.conf = configparser.ConfigParser()
         self.config_file = config_file
+        # accounts refresh their tokens from their own threads
+        self.lock = threading.Lock()
         if not os.path.exists(config_file):
-            print(
-                f"Error: Configuration file '{config_file}' not found. Creating blank config."
-            )
             try:
                 self.conf["Trakt"] = {
                     "client_id": "",
@@ -41,59 +47,74 @@ class Configuration:
                 }
                 with open(config_file, "w", encoding="utf-8") as configfile:
                     self.conf.write(configfile)
-                    print(
-                        "Please configure for oauth, use the -o=CODE parameter "
-                        "and valid config credentials."
-                    )
-            except configparser.Error as error:
-                print("An error occurred:", error)
-            sys.exit(1)
-        else:
-            try:
-                self.conf.read(config_file)
-            except configparser.Error as error:
-                print(f"Error occurred while reading the configuration file: {error}")
-                sys.exit(1)
+            except (configparser.Error, OSError) as error:
+                raise ConfigurationError(f"An error occurred: {error}") from error
+            raise ConfigurationError(
+                f"Error: Configuration file '{config_file}' not found. Creating blank config.\n"
+                "Please configure for oauth, use the -o=CODE parameter "
+                "and valid config credentials."
+            )
+        try:
+            self.conf.read(config_file)
+        except configparser.Error as error:
+            raise ConfigurationError(
+                f"Error occurred while reading the configuration file: {error}"
+            ) from error
+
+    def accounts(self):
+        """the configured trakt accounts, [Trakt] and any [Trakt:name] sections"""
+        return [
+            section
+            for section in self.conf.sections()
+            if section == "Trakt" or section.startswith("Trakt:")
+        ]
+
+    def trakt_value(self, section, key):
+        """
+        reads a trakt account value, an account section without its own
+        client_id/client_secret/redirect_uri uses [Trakt]'s (one api app)
+        """
+        if key in ("client_id", "client_secret", "redirect_uri"):
+            return self.conf.get(
+                section, key, fallback=self.conf.get("Trakt", key, fallback="")
+            )
+        return self.conf.get(section, key)
 
-    def get_oauth(self, args, refresh=False):
-        """gets the oauth token via refresh or code"""
-        authorization_code = None
+    def get_oauth(self, code=None, refresh=False, section="Trakt"):
+        """gets the oauth token via refresh or code, returns the new access token"""
+        authorization_code = code
         try:
-            client_id = self.conf.get("Trakt", "client_id")
-            client_secret = self.conf.get("Trakt", "client_secret")
-            redirect_uri = self.conf.get("Trakt", "redirect_uri")
-            if args.oauth:
-                authorization_code = args.oauth
-            if refresh or args.refresh:
-                authorization_code = self.conf.get("Trakt", "oauth2_refresh")
+            client_id = self.trakt_value(section, "client_id")
+            client_secret = self.trakt_value(section, "client_secret")
+            redirect_uri = self.trakt_value(section, "redirect_uri")
+            if refresh:
+                authorization_code = self.conf.get(section, "oauth2_refresh")
                 if authorization_code is None:
-                    print(
+                    raise TraktAuthError(
                         "Trakt.tv Error: Exchanging refresh token failed. "
                         "You do not have a valid refresh_token in your config. "
                         "Please use -o instead."
                     )
-                    sys.exit(1)
             if (
-                (len(authorization_code) != 64)
+                (authorization_code is None or len(authorization_code) != 64)
                 or (len(client_id) != 64)
                 or (len(client_secret) != 64)
             ):
-                print(
+                raise ConfigurationError(
                     "You need to set and provide a valid code, client_id, and client_secret. "
                     "Please double check, and rerun the oauth command."
                 )
-                sys.exit(1)
             if not re.match(
                 r"^(?:https?://)?(?:[-\w.]+)+(?::\d+)?(?:/.*)?$", redirect_uri
             ):
-                print(
+                raise ConfigurationError(
                     "You need to set the redirect_uri value to match trakt "
                     "and rerun the oauth command."
                 )
-                sys.exit(1)
         except configparser.Error as error:
-            print(f"Error occurred while reading the configuration values: {error}")
-            sys.exit(1)
+            raise ConfigurationError(
+                f"Error occurred while reading the configuration values: {error}"
+            ) from error
 
         oauth_request = {
             "code": authorization_code,
@@ -102,109 +123,142 @@ class Configuration:
             "redirect_uri": redirect_uri,
             "grant_type": "authorization_code",
         }
-        if args.refresh or refresh:
+        if refresh:
             oauth_request["grant_type"] = "refresh_token"
             oauth_request["refresh_token"] = authorization_code
-        try:
-            response = requests.post(
-                "https://api.trakt.tv/oauth/token",
-                json=oauth_request,
-                headers={"Content-Type": "application/json"},
-                timeout=10,
-            )
-            response.raise_for_status()
-            print("Authorization Code: ", authorization_code)
-            print("Access Token: ", response.json().get("access_token"))
-            print("Refresh Token: ", response.json().get("refresh_token"))
-            self.conf.set("Trakt", "oauth2_token", response.json().get("access_token"))
-            self.conf.set(
-                "Trakt", "oauth2_refresh", response.json().get("refresh_token")
-            )
-            with open(self.config_file, "w", encoding="utf-8") as configfile:
-                self.conf.write(configfile)
-                print(
-                    "Your configuration file was successfully updated "
-                    "with your access/refresh token.\n"
+        # other retraktarr processes using this config file wait their turn
+        with FileLock(f"{self.config_file}.lock"):
+            if refresh:
+                # trakt refresh tokens only work once, if another run has
+                # already refreshed this account, take its tokens instead
+                on_disk = configparser.ConfigParser()
+                on_disk.read(self.config_file)
+                if (
+                    on_disk.get(section, "oauth2_refresh", fallback=authorization_code)
+                    != authorization_code
+                ):
+                    with self.lock:
+                        for key in ("oauth2_token", "oauth2_refresh"):
+                            self.conf.set(section, key, on_disk.get(section, key))
+                    logger.info(
+                        "Your access/refresh token was already refreshed by another run.\n"
+                    )
+                    return self.conf.get(section, "oauth2_token")
+            try:
+                response = requests.post(
+                    "https://api.trakt.tv/oauth/token",
+                    json=oauth_request,
+                    headers={"Content-Type": "application/json"},
+                    timeout=10,
                 )
-            if args.refresh is True and refresh is False:
-                sys.exit(1)
-            else:
-                return response.json().get("access_token")
-        except requests.exceptions.RequestException as error:
-            print(error)
-            print("Check your configuration, make sure they match Trakt.tv exactly")
-            print(
-                "Further Information: https://trakt.docs.apiary.io/#introduction/status-codes"
-            )
-            sys.exit(1)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as error:
+                raise TraktAuthError(
+                    f"{error}\n"
+                    "Check your configuration, make sure they match Trakt.tv exactly\n"
+                    "Further Information: https://trakt.docs.apiary.io/#introduction/status-codes"
+                ) from error
+            with self.lock:
+                # keeps whatever other runs wrote to the file meanwhile
+                self.conf.read(self.config_file)
+                self.conf.set(
+                    section, "oauth2_token", response.json().get("access_token")
+                )
+                self.conf.set(
+                    section, "oauth2_refresh", response.json().get("refresh_token")
+                )
+                with open(self.config_file, "w", encoding="utf-8") as configfile:
+                    self.conf.write(configfile)
+        logger.info(
+            "Your configuration file was successfully updated "
+            "with your access/refresh token.\n"
+        )
+        return response.json().get("access_token")
 
-    def validate_trakt_credentials(self):
-        """validates trakt.tv credentials"""
+    def validate_trakt_credentials(self, section="Trakt"):
+        """validates trakt.tv credentials (of the account's section)"""
         try:
-            oauth2_bearer = self.conf.get("Trakt", "oauth2_token")
-            trakt_api_key = self.conf.get("Trakt", "client_id")
-            trakt_secret = self.conf.get("Trakt", "client_secret")
-            user = self.conf.get("Trakt", "username")
+            oauth2_bearer = self.trakt_value(section, "oauth2_token")
+            trakt_api_key = self.trakt_value(section, "client_id")
+            trakt_secret = self.trakt_value(section, "client_secret")
+            user = self.trakt_value(section, "username")
         except configparser.Error as error:
-            print(f"Error occurred while reading the configuration values: {error}")
-            sys.exit(1)
+            raise ConfigurationError(
+                f"Error occurred while reading the configuration values: {error}"
+            ) from error
         if len(user) == 0:
-            print(
+            raise ConfigurationError(
                 "Error: Invalid configuration values. "
-                "[Trakt] username should not be empty."
+                f"[{section}] username should not be empty."
             )
-            sys.exit(1)
         # validate the lengths of all the keys are correct
         if (
             len(oauth2_bearer) != 64
             or len(trakt_api_key) != 64
             or len(trakt_secret) != 64
         ):
-            print(
+            raise ConfigurationError(
                 "Error: Invalid configuration values. "
-                "[Trakt] oauth2_token/client_id/client_secret "
-                "should all have lengths of 64 characters."
-            )
-            print(
+                f"[{section}] oauth2_token/client_id/client_secret "
+                "should all have lengths of 64 characters.\n"
                 "Run with -o parameter with accurate username, redirect_uri, "
                 "client_id, and client_secret values set in config."
             )
-            sys.exit(1)
         return oauth2_bearer, trakt_api_key, user, trakt_secret
 
-    def validate_arr_configuration(self, arr_api, trakt_api, arr, args):
-        """validates the specified arr config"""
+    def validate_arr_configuration(self, arr):
+        """
+        validates the specified arr config
+        returns the url, api key, trakt list and trakt list privacy
+        """
         try:
-            if not args.list:
-                trakt_api.list = None
-            if not args.privacy:
-                trakt_api.list_privacy = None
-
-            arr_api.api_url = self.conf.get(arr, "url").rstrip("/")
-            arr_api.api_key = self.conf.get(arr, "api_key")
-            trakt_api.list_privacy = (
-                self.conf.get(arr, "trakt_list_privacy")
-                if (trakt_api.list_privacy is None)
-                else trakt_api.list_privacy
-            )
-            trakt_api.list = (
-                self.conf.get(arr, "trakt_list")
-                if (trakt_api.list is None)
-                else trakt_api.list
-            )
+            api_url = self.conf.get(arr, "url").rstrip("/")
+            api_key = self.conf.get(arr, "api_key")
+            trakt_list = self.conf.get(arr, "trakt_list")
+            list_privacy = self.conf.get(arr, "trakt_list_privacy")
         except configparser.Error as error:
-            print(f"Error occurred while reading the configuration values: {error}")
-            sys.exit(1)
+            raise ConfigurationError(
+                f"Error occurred while reading the configuration values: {error}"
+            ) from error
         if not re.match(
-            r"^(?:https?://)?(?:.+:.+@)?(?:[-\w.]+)+(?::\d+)?(?:/.*)?$", arr_api.api_url
+            r"^(?:https?://)?(?:.+:.+@)?(?:[-\w.]+)+(?::\d+)?(?:/.*)?$", api_url
         ):
-            print(
+            raise ConfigurationError(
                 f"Error: Invalid configuration value. [{arr}] 'url' does not match a URL pattern."
             )
-            sys.exit(1)
-        if len(arr_api.api_key) != 32:
-            print(
+        if len(api_key) != 32:
+            raise ConfigurationError(
                 f"Error: Invalid configuration values. "
                 f"[{arr}] api_key should have lengths of 32 characters."
             )
-            sys.exit(1)
+        return api_url, api_key, trakt_list, list_privacy
+
+    def sync_job(self, arr, trakt_list=None, privacy=None, account="Trakt", **options):
+        """
+        builds a SyncJob for the arr's config section, the list and privacy
+        default to the config's, any other SyncJob field can be passed.
+        an account section can override the arr's list with radarr_list/
+        sonarr_list (and radarr_list_privacy/sonarr_list_privacy), an arr
+        section's database is its radarr.db/sonarr.db (read-only, optional)
+        """
+        api_url, api_key, config_list, config_privacy = self.validate_arr_configuration(
+            arr
+        )
+        if not self.conf.has_section(account):
+            raise ConfigurationError(
+                f"Error: No [{account}] section found in the configuration file."
+            )
+        return SyncJob(
+            arr=arr,
+            url=api_url,
+            api_key=api_key,
+            trakt_list=trakt_list
+            or self.conf.get(account, f"{arr.lower()}_list", fallback=config_list),
+            privacy=privacy
+            or self.conf.get(
+                account, f"{arr.lower()}_list_privacy", fallback=config_privacy
+            ),
+            account=account,
+            database=self.conf.get(arr, "database", fallback=None) or None,
+            **options,
+        )
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+""" embeddable sync engine - runs sync jobs and returns their results """
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+
+from retraktarr.api.arr import ArrAPI
+from retraktarr.api.trakt import TraktAPI
+from retraktarr.backup import list_entries
+from retraktarr.cache import IDCrossReference
+from retraktarr.changeset import change_from_json, list_plan
+from retraktarr.exceptions import ConfigurationError, ListLimitError
+from retraktarr.models import ListItem, RestoreResult, SyncResult
+from retraktarr.parallel import WorkerPool
+from retraktarr.runlock import RunLock
+from retraktarr.shard import is_shard, plan_shards, shard_name
+from retraktarr.state import StateStore
+from retraktarr.timeouts import TimeoutModel
+
+
+class SyncEngine:
+    """
+    runs arr -> trakt list sync jobs and returns their results. errors are
+    raised (RetraktarrError subclasses), nothing is printed or exited, and
+    sessions, the id cross reference and caches are reused between jobs.
+    several trakt accounts can be synced at once, each on its own thread
+    with its own token and rate limits. with a cassette every arr and trakt
+    request is recorded to it (or replayed from it)
+    """
+
+    def __init__(self, trakt_apis, cassette=None, processes=0, max_memory=None):
+        # account (config section) -> TraktAPI
+        if isinstance(trakt_apis, TraktAPI):
+            trakt_apis = {trakt_apis.account: trakt_apis}
+        self.trakt_apis = trakt_apis
+        self.cassette = cassette
+        # big libraries/lists are decoded and diffed in this many worker
+        # processes (0 keeps everything in this process)
+        self.workers = WorkerPool(processes)
+        # bytes libraries and diffs may each take up before they're streamed
+        # to temporary on-disk stores (None keeps everything in memory)
+        self.max_memory = max_memory
+        # the arr apis learn their timeouts into the (first) account's model
+        self.timeouts = next(iter(trakt_apis.values())).timeouts
+        for account, trakt_api in trakt_apis.items():
+            trakt_api.workers = self.workers
+            trakt_api.max_memory = max_memory
+            if cassette is not None:
+                cassette.mount(trakt_api.trakt_session, account)
+        # (url, api key, database) -> ArrAPI, so each arr instance keeps its session
+        self.arr_apis = {}
+
+    @classmethod
+    def from_config(
+        cls,
+        config,
+        state_dir=None,
+        accounts=None,
+        cassette=None,
+        processes=0,
+        max_memory=None,
+    ):
+        """
+        builds an engine from a Configuration's trakt credentials, for the
+        given accounts (config sections) or every configured one
+        """
+        state = StateStore(state_dir)
+        # trakt ids are the same for every account, so they share one
+        xref = IDCrossReference(state).load()
+        # so are response times (trakt's are the same for every account)
+        timeouts = TimeoutModel(state).load()
+        trakt_apis = {}
+        for account in accounts or config.accounts():
+            (
+                oauth2_bearer,
+                trakt_api_key,
+                trakt_user,
+                trakt_secret,
+            ) = config.validate_trakt_credentials(account)
+            trakt_apis[account] = TraktAPI(
+                oauth2_bearer,
+                trakt_api_key,
+                trakt_user,
+                trakt_secret,
+                state,
+                config=config,
+                account=account,
+                xref=xref,
+                timeouts=timeouts,
+            )
+        return cls(trakt_apis, cassette, processes, max_memory)
+
+    @property
+    def trakt_api(self):
+        """the default ([Trakt]) account's api, or the only one"""
+        return self.trakt_apis.get("Trakt", next(iter(self.trakt_apis.values())))
+
+    def account_api(self, job):
+        """returns the TraktAPI of the job's account"""
+        if job.account not in self.trakt_apis:
+            raise ConfigurationError(
+                f"Error: No [{job.account}] Trakt.tv account configured."
+            )
+        return self.trakt_apis[job.account]
+
+    def arr_api(self, job):
+        """returns the (cached) arr api for a job's arr instance"""
+        if job.arr not in ("Radarr", "Sonarr"):
+            raise ConfigurationError(f"Error: Unknown arr '{job.arr}'.")
+        key = (job.url, job.api_key, job.database)
+        if key not in self.arr_apis:
+            self.arr_apis[key] = ArrAPI(job.url, job.api_key, job.database)
+            self.arr_apis[key].workers = self.workers
+            self.arr_apis[key].timeouts = self.timeouts
+            self.arr_apis[key].max_memory = self.max_memory
+            if self.cassette is not None:
+                self.cassette.mount(self.arr_apis[key].arr_session)
+        return self.arr_apis[key]
+
+    def sync(self, job, arr_data=None, arr_ids=None):
+        """
+        runs one sync job, returns its SyncResult
+        (arr_data is an already fetched library of the job's arr,
+        arr_ids the already filtered ids to sync, used for shards)
+        """
+        if job.shard and arr_ids is None:
+            raise ConfigurationError(
+                "Error: Sharded jobs sync several lists, use sync_shards/sync_all."
+            )
+        libraries = {}
+        if arr_data is not None:
+            libraries[(job.url, job.api_key, job.arr)] = arr_data
+        return self.apply_changes(*self.plan_list([job], libraries, arr_ids))[0]
+
+    def plan_list(self, jobs, libraries=None, arr_ids=None, resume=True):
+        """
+        fetches the list the jobs share (same list and account) and plans
+        each job's changes to it without sending anything. libraries maps a
+        job's (url, api key, arr) to an already fetched library, arr_ids are
+        a single job's already filtered ids, resume=False refuses a list with
+        pending operations instead of resuming them (see TraktAPI.get_list).
+        returns the TraktAPI and changes
+        """
+        libraries = libraries or {}
+        first = jobs[0]
+        trakt_api = self.account_api(first)
+        trakt_api.list = first.trakt_list
+        trakt_api.list_privacy = first.privacy
+
+        started = time.perf_counter()
+        trakt_ids = trakt_api.get_list(
+            self.arr_api(first).endpoint[first.arr][2].rstrip("s"), resume
+        )
+        list_time = time.perf_counter() - started
+
+        # every job's diff is started before any is waited on, so with worker
+        # processes the jobs sharing the list are compared at the same time
+        diffs = []
+        for job in jobs:
+            arr_api = self.arr_api(job)
+            _, idtag, media_type = arr_api.endpoint[job.arr]
+            result = SyncResult(job, media_type)
+            result.resumed = trakt_api.resumed
+            result.resumed_added = trakt_api.resumed_added.get(media_type.lower(), 0)
+            result.timings["trakt_list"] = list_time
+
+            job_ids = arr_ids
+            arr_data = libraries.get((job.url, job.api_key, job.arr))
+            if job_ids is None:
+                started = time.perf_counter()
+                job_ids, arr_data = arr_api.get_list(job, job.arr, arr_data)
+                result.timings["arr_list"] = time.perf_counter() - started
+            result.total = len(job_ids)
+            diffed = trakt_api.start_diff(
+                job, media_type, arr_data, idtag, job_ids, trakt_ids
+            )
+            diffs.append((job, media_type, arr_data, idtag, job_ids, result, diffed))
+
+        changes = []
+        planned = 0
+        for job, media_type, arr_data, idtag, job_ids, result, diffed in diffs:
+            # the limit check counts what the jobs before this one will change
+            change = trakt_api.plan_change(
+                job,
+                media_type,
+                arr_data,
+                idtag,
+                job_ids,
+                trakt_ids,
+                result,
+                planned,
+                diffed,
+            )
+            planned += len(change["needed_ids"]) - len(change["extra_ids"])
+            changes.append(change)
+        return trakt_api, changes
+
+    @staticmethod
+    def apply_changes(trakt_api, changes):
+        """sends planned changes to trakt_api's list, returns their SyncResults"""
+        responses = trakt_api.send_changes(changes)
+        results = [trakt_api.finish_change(change, responses) for change in changes]
+        trakt_api.xref.save()
+        return results
+
+    def shard_jobs(self, job, arr_data=None):
+        """
+        splits a sharded job into a job per numbered list, returns
+        [(shard job, its arr ids)], the library and the time it took to filter
+        """
+        arr_api = self.arr_api(job)
+        _, idtag, media_type = arr_api.endpoint[job.arr]
+        trakt_api = self.account_api(job)
+
+        started = time.perf_counter()
+        arr_ids, arr_data = arr_api.get_list(job, job.arr, arr_data)
+        arr_time = time.perf_counter() - started
+
+        # never use fewer shards than last run, shrinking would reshuffle items
+        trakt_api.get_limits(media_type.rstrip("s"))
+        state_name = trakt_api.state.key("shards", trakt_api.user, job.trakt_list)
+        previous = trakt_api.state.load(state_name, {}).get("count", 1)
+        shards = plan_shards(arr_ids, idtag, trakt_api.list_limit, previous)
+        if trakt_api.list_count_limit is not None:
+            # the account's other lists count against the limit too
+            slug = trakt_api.normalize_trakt(job.trakt_list)
+            others = sum(
+                not is_shard(job.trakt_list, entry["name"])
+                and not is_shard(slug, entry["slug"])
+                for entry in trakt_api.account_lists(media_type.rstrip("s"))
+            )
+            if len(shards) + others > trakt_api.list_count_limit:
+                raise ListLimitError(
+                    f"Error: ({job.trakt_list}) needs {len(shards)} lists, with your "
+                    f"{others} other list(s) that's more than your account allows "
+                    f"({trakt_api.list_count_limit}). You will need Trakt VIP."
+                )
+        trakt_api.state.save(state_name, {"count": len(shards)})
+        return (
+            [
+                (replace(job, trakt_list=shard_name(job.trakt_list, number)), shard_ids)
+                for number, shard_ids in enumerate(shards, start=1)
+            ],
+            arr_data,
+            arr_time,
+        )
+
+    def sync_shards(self, job, arr_data=None):
+        """
+        syncs a library too big for one list over numbered lists (list-1,
+        list-2...), items are assigned by stable hashing so library changes
+        move as few items between lists as possible. returns a SyncResult per list
+        """
+        shards, arr_data, arr_time = self.shard_jobs(job, arr_data)
+        results = []
+        for shard_job, shard_ids in shards:
+            result = self.sync(shard_job, arr_data, shard_ids)
+            result.timings["arr_list"] = arr_time
+            results.append(result)
+        return results
+
+    def sync_shared(self, jobs, libraries=None):
+        """
+        syncs jobs of different arrs (radarr and sonarr) into the same list
+        of one account: the list is fetched once and their removes and adds
+        go out as combined posts. libraries maps a job's (url, api key, arr)
+        to an already fetched library. returns a SyncResult per job
+        """
+        first = jobs[0]
+        if any(
+            job.shard
+            or job.account != first.account
+            or job.trakt_list != first.trakt_list
+            or job.wipe != first.wipe
+            for job in jobs
+        ) or len({job.arr for job in jobs}) != len(jobs):
+            raise ConfigurationError(
+                "Error: Shared syncs need one job per arr, on the same list and "
+                "account (unsharded, all wiping or none)."
+            )
+        return self.apply_changes(*self.plan_list(jobs, libraries))
+
+    def plan(self, jobs):
+        """
+        plans every job without sending anything, returns a plan per list
+        (see retraktarr.changeset, write_changeset saves them) for apply
+        """
+        libraries = self.fetch_libraries(jobs)
+        plans = []
+        for group in self.group_jobs(jobs):
+            group_jobs = [job for _, job in group]
+            library = libraries[
+                (group_jobs[0].url, group_jobs[0].api_key, group_jobs[0].arr)
+            ]
+            if group_jobs[0].shard:
+                shards, library, _ = self.shard_jobs(group_jobs[0], library)
+                # one at a time, the shards share the account's TraktAPI (and
+                # its list state), each has to be serialized before the next
+                planned = (
+                    self.plan_list(
+                        [shard_job],
+                        {(shard_job.url, shard_job.api_key, shard_job.arr): library},
+                        shard_ids,
+                        resume=False,
+                    )
+                    for shard_job, shard_ids in shards
+                )
+            else:
+                planned = [self.plan_list(group_jobs, libraries, resume=False)]
+            for trakt_api, changes in planned:
+                # keep what planning learned/pruned, nothing else is written
+                for change in changes:
+                    if change["not_found_cache"] is not None:
+                        change["not_found_cache"].save()
+                trakt_api.xref.save()
+                plans.append(list_plan(trakt_api, changes))
+        return plans
+
+    def apply(self, plans):
+        """
+        sends planned changes (plan's, or read_changeset's) in chunks at the
+        rate limits, after checking each list hasn't changed since it was
+        planned (TraktError if it has). returns the SyncResults
+        """
+        results = []
+        for plan in plans:
+            if plan["account"] not in self.trakt_apis:
+                raise ConfigurationError(
+                    f"Error: No [{plan['account']}] Trakt.tv account configured."
+                )
+            trakt_api = self.trakt_apis[plan["account"]]
+            trakt_api.check_plan(plan, plan["changes"][0]["media_type"].rstrip("s"))
+            changes = [
+                change_from_json(change, trakt_api) for change in plan["changes"]
+            ]
+            results.extend(self.apply_changes(trakt_api, changes))
+        return results
+
+    @staticmethod
+    def group_jobs(jobs):
+        """
+        groups (index, job) pairs so jobs of different arrs on the same list
+        and account are synced together, everything else on its own
+        """
+        groups = []
+        for index, job in enumerate(jobs):
+            for group in groups:
+                first = group[0][1]
+                if (
+                    not job.shard
+                    and not first.shard
+                    and job.account == first.account
+                    and job.trakt_list == first.trakt_list
+                    and job.wipe == first.wipe
+                    and all(job.arr != other.arr for _, other in group)
+                ):
+                    group.append((index, job))
+                    break
+            else:
+                groups.append([(index, job)])
+        return groups
+
+    def run_lock(self, lists):
+        """
+        a RunLock over the (account, list name) pairs a run will change,
+        keeps overlapping runs (in any process) from changing them together
+        """
+        locks = []
+        for account, list_name in lists:
+            if account not in self.trakt_apis:
+                raise ConfigurationError(
+                    f"Error: No [{account}] Trakt.tv account configured."
+                )
+            trakt_api = self.trakt_apis[account]
+            locks.append(
+                trakt_api.state.lock_path(
+                    trakt_api.state.key("run", trakt_api.user, list_name)
+                )
+            )
+        return RunLock(locks)
+
+    def fetch_libraries(self, jobs):
+        """fetches each arr library the jobs use once, (url, api key, arr) -> library"""
+        library_jobs = {}
+        for job in jobs:
+            self.account_api(job)
+            library_jobs.setdefault((job.url, job.api_key, job.arr), job)
+        # fetched side by side, their decoding can then run in worker processes
+        # (one at a time within max_memory, so their peaks don't add up)
+        fetchers = 1 if self.max_memory is not None else len(library_jobs)
+        with ThreadPoolExecutor(max_workers=max(fetchers, 1)) as executor:
+            futures = {
+                key: executor.submit(self.arr_api(job).get_library, job.arr)
+                for key, job in library_jobs.items()
+            }
+            return {key: future.result() for key, future in futures.items()}
+
+    def sync_all(self, jobs, report=None):
+        """
+        runs every job, returns their results (in the order of the jobs).
+        each arr library is fetched once and shared by every job using it,
+        radarr and sonarr jobs on the same list share its fetch and posts,
+        each account's jobs run in order on a thread of their own. a list
+        failing doesn't stop the others, the results that did finish are
+        passed to report (if given) before the first error is raised
+        """
+        libraries = self.fetch_libraries(jobs)
+
+        account_groups = {}
+        for group in self.group_jobs(jobs):
+            account_groups.setdefault(group[0][1].account, []).append(group)
+
+        results = [None] * len(jobs)
+        errors = []
+
+        def run_account(groups):
+            for group in groups:
+                index, job = group[0]
+                library = libraries[(job.url, job.api_key, job.arr)]
+                try:
+                    if len(group) > 1:
+                        shared = self.sync_shared([job for _, job in group], libraries)
+                        for (index, _), result in zip(group, shared):
+                            results[index] = [result]
+                    elif job.shard:
+                        results[index] = self.sync_shards(job, library)
+                    else:
+                        results[index] = [self.sync(job, library)]
+                except Exception as error:
+                    # raised once every other list has had its turn
+                    errors.append(error)
+
+        with ThreadPoolExecutor(max_workers=max(len(account_groups), 1)) as executor:
+            futures = [
+                executor.submit(run_account, groups)
+                for groups in account_groups.values()
+            ]
+            for future in futures:
+                future.result()
+        finished = [
+            result
+            for job_results in results
+            if job_results is not None
+            for result in job_results
+        ]
+        if report is not None:
+            for result in finished:
+                report(result)
+        if errors:
+            raise errors[0]
+        return finished
+
+    def backup(self, jobs):
+        """compact backups of the jobs' arr libraries, arr -> backup entries"""
+        return {job.arr: self.arr_api(job).get_backup(job.arr) for job in jobs}
+
+    def restore(self, job, entries=None, root_folder=None, workers=4):
+        """
+        adds the titles of backup entries (read_backup's for the job's arr)
+        or, without entries, of the job's trakt list to its arr instance.
+        titles the arr already has are left alone. the job's quality_profile
+        and tag fill in for entries without their own (or ones the instance
+        doesn't have), job.monitored adds everything monitored
+        returns a RestoreResult
+        """
+        arr_api = self.arr_api(job)
+        _, idtag, media_type = arr_api.endpoint[job.arr]
+        result = RestoreResult(job, media_type)
+
+        started = time.perf_counter()
+        unusable = []
+        if entries is None:
+            trakt_api = self.account_api(job)
+            trakt_api.list = job.trakt_list
+            trakt_api.get_list(media_type.rstrip("s"))
+            entries, unusable = list_entries(trakt_api.json, media_type, idtag)
+        result.timings["source"] = time.perf_counter() - started
+        result.total = len(entries) + len(unusable)
+        result.failed = [
+            ListItem("TRAKT", item.get("ids", {}).get("trakt"), item.get("title"))
+            for item in unusable
+        ]
+
+        started = time.perf_counter()
+        library = arr_api.get_library(job.arr)
+        missing = [entry for entry in entries if entry.get(idtag) not in library]
+        result.existing = len(entries) - len(missing)
+        result.timings["arr_list"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if missing:
+            result.restored, failed = arr_api.import_items(
+                job.arr,
+                missing,
+                quality_profile=job.quality_profile,
+                tags=[job.tag] if job.tag else [],
+                monitored=True if job.monitored else None,
+                root_folder=root_folder,
+                workers=workers,
+            )
+            result.failed.extend(
+                ListItem(idtag.upper(), entry.get(idtag), entry.get("title"))
+                for entry in failed
+            )
+        result.timings["import"] = time.perf_counter() - started
+        return result
+
+    def close(self):
+        """closes every session and worker process (and writes a recorded cassette)"""
+        for trakt_api in self.trakt_apis.values():
+            trakt_api.close()
+        for arr_api in self.arr_apis.values():
+            arr_api.close()
+        self.workers.close()
+        if self.cassette is not None:
+            self.cassette.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
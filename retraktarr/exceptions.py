@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+""" typed errors raised by retraktarr (the cli prints them and exits) """
+
+
+class RetraktarrError(Exception):
+    """base class for every retraktarr error"""
+
+
+class ConfigurationError(RetraktarrError):
+    """missing/invalid configuration values or config file"""
+
+
+class ArrError(RetraktarrError):
+    """radarr/sonarr request failed or returned something unusable"""
+
+
+class TraktError(RetraktarrError):
+    """trakt.tv request failed or returned something unusable"""
+
+
+class TraktAuthError(TraktError):
+    """trakt.tv rejected the credentials/token (and refreshing didn't help)"""
+
+
+class ListLimitError(TraktError):
+    """the sync would put the list over the account's item limits"""
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+""" durable journal of planned list operations so interrupted runs can resume """
+import time
+
+
+class SyncJournal:
+    """
+    records every planned operation (list creation, remove chunks, add chunks)
+    for a list before any of them run, and confirms each as trakt accepts it
+    """
+
+    def __init__(self, store, user, list_name):
+        self.store = store
+        self.name = store.key("journal", user, list_name)
+        self.ops = []
+
+    def load(self):
+        """loads an interrupted run's journal, returns the unconfirmed operations"""
+        data = self.store.load(self.name, {})
+        self.ops = data.get("ops", [])
+        return self.pending()
+
+    def plan(self, ops):
+        """writes the planned operations to disk before any of them are sent"""
+        self.ops = [dict(op, done=False) for op in ops]
+        self.save()
+
+    def pending(self):
+        """operations that haven't been confirmed by trakt yet (in order)"""
+        return [op for op in self.ops if not op.get("done")]
+
+    def confirm(self, op):
+        """marks an operation as done, clears the journal once everything is"""
+        op["done"] = True
+        if self.pending():
+            self.save()
+        else:
+            self.clear()
+
+    def save(self):
+        """persists the journal"""
+        self.store.save(self.name, {"planned": int(time.time()), "ops": self.ops})
+
+    def clear(self):
+        """removes the journal (nothing left to resume)"""
+        self.ops = []
+        self.store.delete(self.name)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+""" sync job definitions and results used by the sync engine """
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class SyncJob:
+    """one arr instance -> trakt list sync"""
+
+    arr: str  # "Radarr" or "Sonarr"
+    url: str
+    api_key: str
+    trakt_list: str
+    privacy: str = "private"
+    monitored: bool = False
+    missing: bool = False
+    quality_profile: Optional[str] = None
+    tag: Optional[str] = None
+    genres: list = field(default_factory=list)
+    cat: bool = False
+    wipe: bool = False
+    # the trakt account (config section) the list belongs to
+    account: str = "Trakt"
+    # spread the library over numbered lists (trakt_list-1, trakt_list-2...)
+    shard: bool = False
+    # the arr's radarr.db/sonarr.db, read directly instead of over the api
+    database: Optional[str] = None
+
+
+@dataclass
+class ListItem:
+    """an item reported in a sync result"""
+
+    id_type: str
+    id: object
+    title: Optional[str] = None
+
+
+@dataclass
+class SyncResult:
+    """what a sync job did to its list"""
+
+    job: SyncJob
+    media_type: str
+    added: int = 0
+    removed: list = field(default_factory=list)
+    wiped: int = 0
+    not_found: list = field(default_factory=list)
+    skipped: int = 0
+    listed: int = 0
+    total: int = 0
+    # operations resumed from an interrupted run, and the titles they added
+    resumed: int = 0
+    resumed_added: int = 0
+    # changes left for the next run to stay within the deadline
+    deferred: int = 0
+    # phase -> seconds (trakt_list, arr_list, diff, post)
+    timings: dict = field(default_factory=dict)
+
+
+@dataclass
+class RestoreResult:
+    """what a restore added to an arr instance"""
+
+    job: SyncJob
+    media_type: str
+    restored: int = 0
+    existing: int = 0
+    failed: list = field(default_factory=list)
+    total: int = 0
+    # phase -> seconds (source, arr_list, import)
+    timings: dict = field(default_factory=dict)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+""" cpu bound parsing and diffing, run in worker processes on big multi job runs """
+import json
+import multiprocessing
+import threading
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from retraktarr.exceptions import RetraktarrError
+
+# payloads smaller than this aren't worth the trip to a worker process
+MIN_POOL_ITEMS = 5000
+MIN_POOL_BYTES = 1 << 20
+
+
+def parse_library(content, id_field, radarr):
+    """
+    decodes an arr movie/series response into arr_data, tmdb/tvdb id ->
+    [imdb id, monitored, quality profile id, title, tags, has file, genres]
+    """
+    return {item[id_field]: library_row(item, radarr) for item in json.loads(content)}
+
+
+def library_row(item, radarr):
+    """the arr_data entry of a decoded arr movie/series"""
+    return [
+        item.get("imdbId"),
+        item.get("monitored"),
+        item.get("qualityProfileId"),
+        item.get("title"),
+        item.get("tags"),
+        item.get("hasFile") if radarr else None,
+        item.get("genres"),
+    ]
+
+
+def parse_list(content):
+    """
+    decodes a trakt list items response, keeping only each item's type,
+    title and ids (everything retraktarr uses)
+    """
+    return [
+        {
+            "type": item.get("type"),
+            item.get("type"): {
+                "title": item.get(item.get("type"), {}).get("title"),
+                "ids": item.get(item.get("type"), {}).get("ids", {}),
+            },
+        }
+        for item in json.loads(content)
+    ]
+
+
+def id_array(ids):
+    """packs ids (ints, None as 0) into an array, pickled as raw bytes"""
+    return array("q", [0 if value is None else value for value in ids])
+
+
+def diff_ids(arr_ids, arr_trakt_ids, listed_trakt_ids, listed_tags, wipe, remove):
+    """
+    compares the wanted arr items with the list's items on trakt ids.
+    every argument is an id_array: the arr ids and the trakt ids they
+    resolve to (0 unknown), the listed items' trakt ids and tmdb/tvdb ids.
+    returns id_arrays of the arr ids that need adding, the positions of the
+    listed items to remove (if remove) and [arr position, listed position]
+    pairs of items listed under an outdated tmdb/tvdb id
+    """
+    listed = {trakt_id: position for position, trakt_id in enumerate(listed_trakt_ids)}
+    wanted = set()
+    needed_ids = array("q")
+    corrections = array("q")
+    for position, (arr_id, trakt_id) in enumerate(zip(arr_ids, arr_trakt_ids)):
+        if trakt_id and trakt_id in listed and not wipe:
+            wanted.add(trakt_id)
+            if listed_tags[listed[trakt_id]] != arr_id:
+                corrections.extend((position, listed[trakt_id]))
+        else:
+            needed_ids.append(arr_id)
+    extra = array("q")
+    if remove:
+        extra.extend(
+            position for trakt_id, position in listed.items() if trakt_id not in wanted
+        )
+    return needed_ids, extra, corrections
+
+
+def pool_error(error):
+    """the RetraktarrError for a failed worker pool"""
+    return RetraktarrError(
+        f"Error: Worker processes failed ({error}), try fewer --processes or 0."
+    )
+
+
+def pass_result(future, pooled):
+    """settles future with a worker's result, a broken pool as a RetraktarrError"""
+    if pooled.cancelled():
+        future.cancel()
+        return
+    error = pooled.exception()
+    if isinstance(error, BrokenProcessPool):
+        wrapped = pool_error(error)
+        wrapped.__cause__ = error
+        future.set_exception(wrapped)
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(pooled.result())
+
+
+class WorkerPool:
+    """
+    runs parse/diff functions in a pool of worker processes (so several jobs'
+    work isn't serialized by the gil), or inline with processes=0 or for
+    small payloads. submit is thread safe, every account thread shares one pool
+    """
+
+    def __init__(self, processes=0):
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, size=0, min_size=MIN_POOL_ITEMS):
+        """
+        runs function(*args), in a worker if its payload's size (items, or
+        bytes with min_size=MIN_POOL_BYTES) is worth it. returns a Future,
+        worker processes failing (killed, out of memory) raise a RetraktarrError
+        """
+        future = Future()
+        if self.processes and size >= min_size:
+            try:
+                with self.lock:
+                    if self.executor is None:
+                        # spawned workers only import this module, forking a
+                        # process with sessions and threads around isn't safe
+                        self.executor = ProcessPoolExecutor(
+                            max_workers=self.processes,
+                            mp_context=multiprocessing.get_context("spawn"),
+                        )
+                    pooled = self.executor.submit(function, *args)
+            except (BrokenProcessPool, OSError, RuntimeError) as error:
+                raise pool_error(error) from error
+            pooled.add_done_callback(partial(pass_result, future))
+            return future
+        try:
+            future.set_result(function(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def close(self):
+        """shuts the worker processes down"""
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
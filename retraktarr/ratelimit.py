@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+""" per account rate limiting matching trakt's per user api limits """
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # windows, every process keeps its own bucket
+    fcntl = None
+
+# trakt.tv limits per user (https://trakt.docs.apiary.io/#introduction/rate-limiting)
+# AUTHED_API_GET_LIMIT: 1000 calls every 5 minutes
+# AUTHED_API_POST_LIMIT: 1 call per second (POST/PUT/DELETE)
+TRAKT_GET_LIMIT = (1000, 300)
+TRAKT_POST_LIMIT = (1, 1)
+
+
+class RateLimiter:
+    """token bucket allowing `calls` every `period` seconds (thread safe)"""
+
+    def __init__(self, calls, period):
+        self.rate = calls / period
+        self.capacity = calls
+        self.tokens = float(calls)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """tops the bucket up for the time passed since the last call"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """takes a token, waiting for one if the bucket is empty"""
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        """empties the bucket for `seconds` (trakt's Retry-After on a 429)"""
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    token bucket shared by every retraktarr process on the host that uses
+    the same bucket file (kept in the state directory, flock protected), so
+    overlapping cron runs stay within the account's limits together.
+    a call reserves its token up front and waits outside the lock, processes
+    are served in order without polling. falls back to a per process bucket
+    where file locking isn't available
+    """
+
+    def __init__(self, calls, period, bucket_path):
+        super().__init__(calls, period)
+        self.bucket_path = bucket_path
+
+    def update(self, take=0, pause=0):
+        """
+        refills the shared bucket (wall clock, it's shared between processes),
+        takes/pauses under the file lock and returns how long to wait
+        """
+        os.makedirs(os.path.dirname(self.bucket_path), exist_ok=True)
+        with open(self.bucket_path, "a+", encoding="utf-8") as bucket_file:
+            fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            try:
+                bucket_file.seek(0)
+                try:
+                    bucket = json.loads(bucket_file.read() or "{}")
+                except ValueError:
+                    bucket = {}
+                now = time.time()
+                updated = min(bucket.get("updated", now), now)
+                tokens = min(
+                    self.capacity,
+                    bucket.get("tokens", self.capacity) + (now - updated) * self.rate,
+                )
+                if pause:
+                    tokens = min(tokens, 0) - pause * self.rate
+                tokens -= take
+                bucket_file.seek(0)
+                bucket_file.truncate()
+                bucket_file.write(json.dumps({"tokens": tokens, "updated": now}))
+                bucket_file.flush()
+            finally:
+                fcntl.flock(bucket_file, fcntl.LOCK_UN)
+        return max(0, -tokens / self.rate)
+
+    def acquire(self):
+        """takes a token from the shared bucket, waiting for its turn if it's empty"""
+        if fcntl is None:
+            super().acquire()
+            return
+        with self.lock:
+            wait = self.update(take=1)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """empties the shared bucket for `seconds` (trakt's Retry-After on a 429)"""
+        if fcntl is None:
+            super().pause(seconds)
+            return
+        with self.lock:
+            self.update(pause=seconds)
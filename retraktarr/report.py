@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+""" buffered reporting of sync/restore/plan results (summary, verbose or jsonl) """
+import json
+import sys
+
+from retraktarr.exceptions import ConfigurationError
+
+MODES = ("summary", "verbose", "jsonl")
+
+
+class Reporter:
+    """
+    formats results into a buffer that's written out in one go by flush (at
+    the end of each phase), instead of a print per line. summary leaves out
+    the per item lines, verbose is retraktarr's usual output with titles,
+    jsonl writes a json object per result for scripts
+    """
+
+    def __init__(self, mode="verbose", stream=None):
+        if mode not in MODES:
+            raise ConfigurationError(f"Error: Unknown report mode ({mode}).")
+        self.mode = mode
+        self.stream = sys.stdout if stream is None else stream
+        self.lines = []
+
+    @property
+    def titles(self):
+        """whether titles are worth looking up for the report"""
+        return self.mode != "summary"
+
+    def flush(self):
+        """writes out everything reported since the last flush"""
+        if self.lines:
+            self.lines.append("")
+            self.stream.write("\n".join(self.lines))
+            self.stream.flush()
+            self.lines = []
+
+    def record(self, kind, data):
+        self.lines.append(json.dumps({"kind": kind, **data}))
+
+    @staticmethod
+    def items(items):
+        return [
+            {"id_type": item.id_type, "id": item.id, "title": item.title}
+            for item in items
+        ]
+
+    def item_lines(self, items):
+        if self.mode == "verbose":
+            self.lines.extend(
+                f"        {item.id_type}: {item.title} - {item.id}" for item in items
+            )
+
+    def sync(self, result):
+        """reports a sync result"""
+        job = result.job
+        if self.mode == "jsonl":
+            self.record(
+                "sync",
+                {
+                    "arr": job.arr,
+                    "account": job.account,
+                    "list": job.trakt_list,
+                    "media_type": result.media_type,
+                    "added": result.added,
+                    "removed": self.items(result.removed),
+                    "wiped": result.wiped,
+                    "not_found": self.items(result.not_found),
+                    "skipped": result.skipped,
+                    "deferred": result.deferred,
+                    "resumed": result.resumed,
+                    "resumed_added": result.resumed_added,
+                    "listed": result.listed,
+                    "total": result.total,
+                    "timings": result.timings,
+                },
+            )
+            return
+        media_type = result.media_type.title()
+        header = job.arr
+        if job.account != "Trakt":
+            header = f"{header} -> {job.account}"
+        if job.shard:
+            header = f"{header} ({job.trakt_list})"
+        self.lines.append(f"[{header}]")
+        if not job.wipe and result.removed:
+            self.lines.append(f"Number of Deleted {media_type}:  {len(result.removed)}")
+            self.item_lines(result.removed)
+        self.lines.append(f"Number of {media_type} Added: {result.added}")
+        self.lines.append(f"Number of {media_type} Not Found: {len(result.not_found)}")
+        self.item_lines(result.not_found)
+        if result.skipped > 0:
+            self.lines.append(
+                f"Number of {media_type} Skipped (Not Found Previously): "
+                f"{result.skipped}"
+            )
+        if result.deferred > 0:
+            self.lines.append(
+                f"Number of {media_type} Changes Deferred (Deadline): "
+                f"{result.deferred}"
+            )
+        if result.resumed > 0:
+            self.lines.append(
+                f"Number of Operations Resumed (Interrupted Run): {result.resumed}"
+            )
+            self.lines.append(
+                f"Number of {media_type} Added by Resumed Operations: "
+                f"{result.resumed_added}"
+            )
+        self.lines.append(f"Number of {media_type} Listed: {result.listed}")
+        self.lines.append(
+            f"Total {'Movies' if job.arr == 'Radarr' else 'Series'}: {result.total}\n"
+        )
+
+    def restore(self, result):
+        """reports a restore result in the same style as a sync"""
+        job = result.job
+        if self.mode == "jsonl":
+            self.record(
+                "restore",
+                {
+                    "arr": job.arr,
+                    "media_type": result.media_type,
+                    "restored": result.restored,
+                    "existing": result.existing,
+                    "failed": self.items(result.failed),
+                    "total": result.total,
+                    "timings": result.timings,
+                },
+            )
+            return
+        media_type = result.media_type.title()
+        self.lines.append(f"[{job.arr}] Restore")
+        self.lines.append(f"Number of {media_type} Restored: {result.restored}")
+        self.lines.append(
+            f"Number of {media_type} Already in {job.arr}: {result.existing}"
+        )
+        self.lines.append(f"Number of {media_type} Failed: {len(result.failed)}")
+        self.item_lines(result.failed)
+        self.lines.append(
+            f"Total {'Movies' if job.arr == 'Radarr' else 'Series'}: {result.total}\n"
+        )
+
+    def plan(self, plan):
+        """reports what a planned list change set will do"""
+        if self.mode == "jsonl":
+            self.record(
+                "plan",
+                {
+                    "account": plan["account"],
+                    "list": plan["list"],
+                    "changes": [
+                        {
+                            "arr": change["job"]["arr"],
+                            "media_type": change["media_type"],
+                            "delete": len(change["extra_ids"]),
+                            "add": len(change["needed_ids"]),
+                            "outdated_ids": len(change["corrections"]),
+                        }
+                        for change in plan["changes"]
+                    ],
+                    "expected_count": plan["expected_count"],
+                    "list_limit": plan["list_limit"],
+                },
+            )
+            return
+        header = plan["list"]
+        if plan["account"] != "Trakt":
+            header = f"{header} -> {plan['account']}"
+        self.lines.append(f"[{header}] Plan")
+        for change in plan["changes"]:
+            media_type = change["media_type"].title()
+            if not change["job"]["wipe"]:
+                self.lines.append(
+                    f"Number of {media_type} to Delete: {len(change['extra_ids'])}"
+                )
+            self.lines.append(
+                f"Number of {media_type} to Add: {len(change['needed_ids'])}"
+            )
+            if change["corrections"]:
+                self.lines.append(
+                    f"Number of {media_type} With Outdated IDs: "
+                    f"{len(change['corrections'])}"
+                )
+        limit = plan["list_limit"] if plan["list_limit"] is not None else "unknown"
+        self.lines.append(
+            f"Expected List Size: {plan['expected_count']} (Limit: {limit})\n"
+        )
+
+    def message(self, text):
+        """a plain status line (left out of jsonl)"""
+        if self.mode != "jsonl":
+            self.lines.append(text)
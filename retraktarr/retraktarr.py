@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 """ main script, arguments and executions """
 import argparse
+import logging
 import sys
+import time
 from os import path
 
-from retraktarr.api.arr import ArrAPI
-from retraktarr.api.trakt import TraktAPI
+from retraktarr.backup import read_backup, write_backup
+from retraktarr.cassette import Cassette
+from retraktarr.changeset import read_changeset, write_changeset
 from retraktarr.config import Configuration
+from retraktarr.engine import SyncEngine
+from retraktarr.exceptions import RetraktarrError
+from retraktarr.report import MODES, Reporter
 
 
 def main():
@@ -89,6 +95,12 @@ def main():
         help="Erases the associated list and performs a sync "
         "(requires -all or -r/s)",
     )
+    parser.add_argument(
+        "--shard",
+        action="store_true",
+        help="Spreads the library over numbered lists (LIST-1, LIST-2...) "
+        "when it doesn't fit your Trakt.tv list item limits",
+    )
     parser.add_argument(
         "--privacy",
         "-p",
@@ -110,8 +122,9 @@ def main():
     )
     parser.add_argument(
         "--timeout",
-        type=str,
-        help="Specifies the timeout in seconds to use for " "POST commands to Trakt.tv",
+        type=float,
+        help="Specifies the timeout in seconds to use for "
+        "POST commands to Trakt.tv (overrides the learned timeouts)",
     )
     parser.add_argument(
         "--version",
@@ -126,6 +139,122 @@ def main():
         default=None,
         help="If a path is provided, retraktarr will use this config file, otherwise it outputs default config location.",
     )
+    parser.add_argument(
+        "--not-found-ttl",
+        type=float,
+        help="Days to leave items Trakt.tv could not find out of adds before "
+        "retrying them (default 7, 0 disables)",
+    )
+    parser.add_argument(
+        "--lookup",
+        type=int,
+        help="Look up Trakt.tv IDs for up to this many Arr items per run that "
+        "haven't been seen on a list yet (default 0)",
+    )
+    parser.add_argument(
+        "--account",
+        action="append",
+        help="Only sync (or authorize with -o/--refresh) this Trakt.tv account, "
+        "the name of its config section, e.g. Trakt or Trakt:kids "
+        "(can be repeated, defaults to every account)",
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=str,
+        help="Directory for retraktarr's run state (resume journals), "
+        "defaults to $XDG_STATE_HOME/retraktarr",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        help="Seconds the run has to finish in, changes that wouldn't make it "
+        "(removals go first, then monitored additions) are left for the next run",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        help="Records every Arr/Trakt.tv request and response of the run "
+        "(redacted) to this cassette file",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        help="Replays a --record cassette file instead of contacting the Arr/Trakt.tv",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        choices=["recorded", "zero"],
+        default="recorded",
+        help="Replay responses at their recorded latency or instantly "
+        "(default recorded)",
+    )
+    parser.add_argument(
+        "--backup",
+        type=str,
+        help="Writes a compact backup of the Radarr/Sonarr libraries "
+        "(-r/-s/-all) to this file, for --restore",
+    )
+    parser.add_argument(
+        "--restore",
+        action="store",
+        nargs="?",
+        const=True,
+        default=None,
+        help="Adds the titles missing from Radarr/Sonarr (-r/-s/-all) from a "
+        "--backup file if a path is provided, otherwise from the Trakt.tv list",
+    )
+    parser.add_argument(
+        "--root-folder",
+        type=str,
+        help="Root folder for restored titles that don't have one "
+        "(defaults to the Arr's first root folder)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of import requests sent to the Arr at once "
+        "when restoring (default 4)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Decodes and compares big libraries/lists in this many worker "
+        "processes, for multi-core hosts syncing several large jobs (default 0, off)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        help="Keeps big Arr libraries and comparisons within about this many MB, "
+        "moving them to temporary files on disk past it (for low memory hosts)",
+    )
+    parser.add_argument(
+        "--plan",
+        type=str,
+        help="Works out the sync's changes without sending them and writes "
+        "them to this change set file, for --apply",
+    )
+    parser.add_argument(
+        "--apply",
+        type=str,
+        help="Sends the changes of a --plan change set file, "
+        "if the lists haven't changed since",
+    )
+    parser.add_argument(
+        "--report",
+        choices=MODES,
+        default="verbose",
+        help="How results are printed: summary (counts only), verbose (also the "
+        "titles deleted/not found) or jsonl (a JSON object per result) (default verbose)",
+    )
+    parser.add_argument(
+        "--if-running",
+        choices=["exit", "rerun"],
+        default="rerun",
+        help="What to do when another run is changing the same lists: exit, or "
+        "run once it's done (overlapping runs queue up as one rerun) (default rerun)",
+    )
     args = parser.parse_args()
     print(f"\nretraktarr v{VERSION}")
     if args.version:
@@ -142,75 +271,176 @@ def main():
             exit(0)
 
     print(f"Validating Configuration File: {config_path}\n")
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    try:
+        run(parser, args, config_path)
+    except RetraktarrError as error:
+        print(error)
+        sys.exit(1)
+
+
+def run(parser, args, config_path):
+    """runs the cli over the sync engine"""
+    started = time.monotonic()
     config = Configuration(config_path)
+    accounts = args.account or config.accounts()
     if args.oauth:
-        config.get_oauth(args)
+        config.get_oauth(code=args.oauth, section=accounts[0])
+        print("Authorization Code: ", args.oauth)
+        print("Access Token: ", config.conf.get(accounts[0], "oauth2_token"))
+        print("Refresh Token: ", config.conf.get(accounts[0], "oauth2_refresh"))
     if args.refresh:
-        config.get_oauth(args)
+        config.get_oauth(refresh=True, section=accounts[0])
+        print("Access Token: ", config.conf.get(accounts[0], "oauth2_token"))
+        print("Refresh Token: ", config.conf.get(accounts[0], "oauth2_refresh"))
+        sys.exit(1)
 
-    (
-        oauth2_bearer,
-        trakt_api_key,
-        trakt_user,
-        trakt_secret,
-    ) = config.validate_trakt_credentials()
-    arr_api = None
-    trakt_api = TraktAPI(oauth2_bearer, trakt_api_key, trakt_user, trakt_secret)
-    if args.list:
-        trakt_api.list = args.list
-    if args.privacy:
-        trakt_api.list_privacy = args.privacy
-    if args.timeout:
-        trakt_api.post_timeout = args.timeout
-    if args.radarr or args.all or args.sonarr:
-        arr_api = ArrAPI()
+    job_options = {
+        "trakt_list": args.list,
+        "privacy": args.privacy,
+        "monitored": args.mon,
+        "missing": args.missing,
+        "quality_profile": args.qualityprofile,
+        "tag": args.tag,
+        "genres": (
+            [genre.strip() for genre in args.genre.split(",")] if args.genre else []
+        ),
+        "cat": args.cat,
+        "wipe": args.wipe,
+        "shard": args.shard,
+    }
+    jobs = []
+    for account in accounts:
+        if args.radarr or args.all:
+            jobs.append(config.sync_job("Radarr", account=account, **job_options))
+        if args.sonarr or args.all:
+            jobs.append(config.sync_job("Sonarr", account=account, **job_options))
 
-    if args.radarr or args.all:
-        config.validate_arr_configuration(arr_api, trakt_api, "Radarr", args)
-        tvdb_ids, tmdb_ids, imdb_ids, trakt_ids = trakt_api.get_list(
-            args, arr_api.endpoint["Radarr"][0]
-        )
-        arr_ids, arr_imdb, arr_data = arr_api.get_list(args, "Radarr")
-        print("[Radarr]")
-        trakt_api.add_to_list(
-            args,
-            arr_api.endpoint["Radarr"][2],
-            arr_data,
-            tmdb_ids,
-            arr_api.endpoint["Radarr"][1],
-            imdb_ids,
-            arr_ids,
-            arr_imdb,
-            trakt_ids,
-        )
-        print(f"Total Movies: {len(arr_ids)}\n")
+    cassette = None
+    if args.replay:
+        cassette = Cassette(args.replay, "replay", args.replay_latency)
+    elif args.record:
+        cassette = Cassette(args.record, "record")
+    with SyncEngine.from_config(
+        config,
+        state_dir=args.state_dir,
+        accounts=accounts,
+        cassette=cassette,
+        processes=args.processes,
+        max_memory=args.max_memory * 1024 * 1024 if args.max_memory else None,
+    ) as engine:
+        reporter = Reporter(args.report)
+        for trakt_api in engine.trakt_apis.values():
+            trakt_api.report_titles = reporter.titles
+            if args.timeout:
+                trakt_api.post_timeout = args.timeout
+            if args.lookup:
+                trakt_api.lookup_limit = args.lookup
+            if args.not_found_ttl is not None:
+                trakt_api.not_found_ttl = args.not_found_ttl * 86400
+            if args.deadline is not None:
+                trakt_api.deadline = started + args.deadline
+        if args.apply:
+            plans = read_changeset(args.apply)
+            lock = hold_lists(
+                engine,
+                [
+                    (plan["account"], plan.get("run_list", plan["list"]))
+                    for plan in plans
+                ],
+                args,
+            )
+            try:
+                for result in engine.apply(plans):
+                    reporter.sync(result)
+            finally:
+                lock.release()
+            reporter.flush()
+            sys.exit(0)
+        if not jobs:
+            parser.print_help()
+            return
+        if args.plan:
+            plans = engine.plan(jobs)
+            write_changeset(args.plan, plans)
+            for plan in plans:
+                reporter.plan(plan)
+            reporter.message(f"Change set written to {args.plan}")
+            reporter.flush()
+            sys.exit(0)
+        # backups and restores only need one account's jobs
+        if args.backup:
+            libraries = engine.backup(
+                [job for job in jobs if job.account == accounts[0]]
+            )
+            write_backup(args.backup, libraries)
+            for arr, entries in libraries.items():
+                reporter.message(
+                    f"[{arr}] Backed up {len(entries)} titles to {args.backup}"
+                )
+            reporter.flush()
+            sys.exit(0)
+        if args.restore:
+            libraries = read_backup(args.restore) if args.restore is not True else {}
+            jobs = [job for job in jobs if job.account == accounts[0]]
+            # restoring from the list reads it, which resumes its pending operations
+            lock = None
+            if args.restore is True:
+                lock = hold_lists(
+                    engine, [(job.account, job.trakt_list) for job in jobs], args
+                )
+            try:
+                for job in jobs:
+                    if args.restore is not True and job.arr not in libraries:
+                        reporter.message(
+                            f"[{job.arr}] Not in backup {args.restore}, skipping.\n"
+                        )
+                        continue
+                    reporter.restore(
+                        engine.restore(
+                            job,
+                            (
+                                libraries.get(job.arr)
+                                if args.restore is not True
+                                else None
+                            ),
+                            root_folder=args.root_folder,
+                            workers=args.workers,
+                        )
+                    )
+            finally:
+                if lock is not None:
+                    lock.release()
+            reporter.flush()
+            sys.exit(0)
+        lock = hold_lists(engine, [(job.account, job.trakt_list) for job in jobs], args)
+        try:
+            engine.sync_all(jobs, reporter.sync)
+        finally:
+            lock.release()
+            reporter.flush()
+    sys.exit(0)
 
-    if args.sonarr or args.all:
-        config.validate_arr_configuration(arr_api, trakt_api, "Sonarr", args)
-        tvdb_ids, tmdb_ids, imdb_ids, trakt_ids = trakt_api.get_list(
-            args, arr_api.endpoint["Sonarr"][2].rstrip("s")
-        )
 
-        arr_ids, arr_imdb, arr_data = arr_api.get_list(args, "Sonarr")
-        print("[Sonarr]")
-        trakt_api.add_to_list(
-            args,
-            arr_api.endpoint["Sonarr"][2],
-            arr_data,
-            tvdb_ids,
-            arr_api.endpoint["Sonarr"][1],
-            imdb_ids,
-            arr_ids,
-            arr_imdb,
-            trakt_ids,
-        )
-        print(f"Total Series: {len(arr_ids)}")
+def hold_lists(engine, lists, args):
+    """
+    takes the run lock on the lists, if another run has them either exits
+    or (--if-running rerun) waits to run after it, exits if a rerun is queued already
+    """
+    lock = engine.run_lock(lists)
+    if lock.acquire():
+        return lock
+    if args.if_running == "exit":
+        print("Another retraktarr run is changing these lists, exiting.")
         sys.exit(0)
-
-    if args.radarr or args.all:
+    if not lock.queue():
+        print(
+            "Another retraktarr run is changing these lists and a rerun "
+            "is already queued after it, exiting."
+        )
         sys.exit(0)
-
-    parser.print_help()
+    print("Waited for another retraktarr run changing these lists, running now.\n")
+    return lock
 
 
 if __name__ == "__main__":
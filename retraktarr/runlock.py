@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+""" keeps overlapping retraktarr runs (cron) off the same lists and config file """
+import hashlib
+import os
+
+try:
+    import fcntl
+except ImportError:  # windows, runs aren't kept apart
+    fcntl = None
+
+
+class FileLock:
+    """exclusive lock on a lock file, held across processes (flock)"""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.lock_file = None
+
+    def acquire(self, blocking=True):
+        """takes the lock, returns False if it's held and not blocking"""
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        lock_file = open(self.lock_path, "a+", encoding="utf-8")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        """lets the lock go"""
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class RunLock:
+    """
+    single flight lock over the lists a run changes. a run that finds one of
+    them busy can queue up as the follow-up run instead of running alongside:
+    only one run per set of lists waits at a time, so any number of
+    overlapping triggers collapse into at most one run after the current one
+    """
+
+    def __init__(self, lock_paths):
+        # always taken in the same order, two runs can't wait on each other
+        lock_paths = sorted(set(lock_paths))
+        self.locks = [FileLock(lock_path) for lock_path in lock_paths]
+        # (no lists, nothing to hold or queue for)
+        self.queue_lock = None
+        if lock_paths:
+            scope = hashlib.sha1("\n".join(lock_paths).encode()).hexdigest()[:12]
+            self.queue_lock = FileLock(
+                os.path.join(os.path.dirname(lock_paths[0]), f"queued_{scope}.lock")
+            )
+
+    def acquire(self):
+        """takes every list's lock without waiting, False if any is busy"""
+        for number, lock in enumerate(self.locks):
+            if not lock.acquire(blocking=False):
+                for held in self.locks[:number]:
+                    held.release()
+                return False
+        return True
+
+    def queue(self):
+        """
+        waits for the lists as the follow-up run, returns False right away
+        if another run is already waiting for them (its run covers this one)
+        """
+        if self.queue_lock is None:
+            return True
+        if not self.queue_lock.acquire(blocking=False):
+            return False
+        try:
+            for lock in self.locks:
+                lock.acquire()
+        finally:
+            # the next trigger can queue up behind this run now
+            self.queue_lock.release()
+        return True
+
+    def release(self):
+        """lets every list go"""
+        for lock in self.locks:
+            lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" post cost estimates, used to fit a run's planned operations into a deadline """
+
+
+class LatencyModel:
+    """
+    running estimate of how long a trakt post takes: a fixed part plus a
+    part per item sent (exponentially weighted, kept between runs)
+    """
+
+    def __init__(self, store, user, alpha=0.3):
+        self.store = store
+        self.name = store.key("latency", user)
+        self.alpha = alpha
+        self.base = 0.5
+        self.per_item = 0.01
+
+    def load(self):
+        """loads the estimates of earlier runs"""
+        data = self.store.load(self.name, {})
+        self.base = data.get("base", self.base)
+        self.per_item = data.get("per_item", self.per_item)
+        return self
+
+    def save(self):
+        """writes the estimates back"""
+        self.store.save(self.name, {"base": self.base, "per_item": self.per_item})
+
+    def estimate(self, items):
+        """seconds a post of `items` items is expected to take"""
+        return self.base + self.per_item * items
+
+    def observe(self, items, seconds):
+        """updates the estimates with a post that took `seconds`"""
+        if items == 0:
+            self.base += self.alpha * (seconds - self.base)
+        else:
+            self.per_item += self.alpha * (
+                max(seconds - self.base, 0) / items - self.per_item
+            )
+
+
+def op_items(op):
+    """number of items an operation sends (list creation sends none)"""
+    if op["op"] == "create":
+        return 0
+    return sum(len(items) for items in op["body"].values())
+
+
+def trim_body(body, count):
+    """the first `count` items of a {type: [items]} body"""
+    trimmed = {}
+    for key, items in body.items():
+        if count <= 0:
+            break
+        trimmed[key] = items[:count]
+        count -= len(trimmed[key])
+    return trimmed
+
+
+def fit_ops(ops, seconds, model, min_interval=0):
+    """
+    keeps the planned operations (in order) that are expected to finish
+    within `seconds`, the one that crosses the line is cut down to the items
+    that still fit and everything after it is left for the next run.
+    list creation is always kept. min_interval is the rate limit's spacing
+    between posts. returns the kept operations
+    """
+    kept = []
+    used = 0
+    for op in ops:
+        cost = max(model.estimate(op_items(op)), min_interval)
+        if op["op"] == "create" or used + cost <= seconds:
+            kept.append(op)
+            used += cost
+            continue
+        room = seconds - used - max(model.base, min_interval)
+        fits = int(room / model.per_item) if model.per_item > 0 else 0
+        if fits > 0:
+            kept.append(dict(op, body=trim_body(op["body"], fits)))
+        break
+    return kept
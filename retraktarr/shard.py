@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+""" spreads a library over numbered lists (movies-1, movies-2...) by stable hashing """
+import hashlib
+import math
+import re
+
+# initial shard count aims at this much of the list limit, leaving room to grow
+SHARD_FILL = 0.9
+
+
+def jump_hash(key, buckets):
+    """
+    jump consistent hash (lamping & veach), going from n to n + 1 buckets
+    only moves 1 / (n + 1) of the keys, all of them into the new bucket
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_key(idtag, arr_id):
+    """stable 64 bit key for an arr id (the same on every run and machine)"""
+    return int.from_bytes(
+        hashlib.blake2b(f"{idtag}:{arr_id}".encode(), digest_size=8).digest(), "big"
+    )
+
+
+def assign_shards(arr_ids, idtag, count):
+    """splits arr ids into `count` lists, returns [ids of shard 1, shard 2...]"""
+    shards = [[] for _ in range(count)]
+    for arr_id in arr_ids:
+        shards[jump_hash(shard_key(idtag, arr_id), count)].append(arr_id)
+    return shards
+
+
+def plan_shards(arr_ids, idtag, list_limit, min_count=1):
+    """
+    picks the smallest shard count (never fewer than min_count, the count
+    used last run, so nothing moves while the library shrinks) where no
+    shard goes over the list limit, returns the assigned shards
+    """
+    count = max(min_count, math.ceil(len(arr_ids) / (list_limit * SHARD_FILL)), 1)
+    shards = assign_shards(arr_ids, idtag, count)
+    while max(len(shard) for shard in shards) > list_limit:
+        count += 1
+        shards = assign_shards(arr_ids, idtag, count)
+    return shards
+
+
+def shard_name(list_name, number):
+    """the name of a shard list (1 based)"""
+    return f"{list_name}-{number}"
+
+
+def base_name(shard_list):
+    """the list a shard list (list-1, list-2...) belongs to"""
+    return re.sub("-[0-9]+$", "", shard_list)
+
+
+def is_shard(list_name, name):
+    """whether name is one of list_name's shard lists"""
+    return re.fullmatch(f"{re.escape(list_name)}-[0-9]+", name or "") is not None
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+""" bounded memory (--max-memory): streamed decoding and temporary on-disk stores """
+import codecs
+import json
+import sqlite3
+import threading
+from array import array
+from collections.abc import ItemsView, Mapping
+
+# rough resident size of an arr_data entry (the list, its title, tags and genres)
+ROW_BYTES = 600
+# sqlite page cache of each temporary store (KiB)
+CACHE_KIB = 2048
+# bytes read at a time from a streamed response
+CHUNK_SIZE = 1 << 16
+
+
+def spill_limit(max_memory):
+    """
+    how many entries a library (or diff) may keep in memory under a
+    max_memory byte cap, a quarter of it goes to each
+    """
+    return max(max_memory // 4 // ROW_BYTES, 1000)
+
+
+def temporary_database():
+    """
+    a private temporary on-disk sqlite database (deleted when closed), with
+    a small page cache so it doesn't hold its contents in memory
+    """
+    connection = sqlite3.connect("", check_same_thread=False)
+    connection.execute(f"PRAGMA cache_size = -{CACHE_KIB}")
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    return connection
+
+
+def iter_array(chunks):
+    """
+    decodes a json array an element at a time from byte chunks (a streamed
+    response's iter_content), so neither the whole body nor all of its
+    decoded elements are in memory at once
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position < len(buffer):
+            char = buffer[position]
+            if not started:
+                if char != "[":
+                    raise ValueError("expected a json array")
+                started = True
+                position += 1
+                continue
+            if char == "]":
+                return
+            if char == ",":
+                position += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the element goes on in the next chunk
+                if finished:
+                    raise
+            else:
+                # a number is only whole once something follows it
+                if (
+                    isinstance(item, (dict, list, str))
+                    or finished
+                    or end < len(buffer)
+                    and buffer[end] in ",] \t\r\n"
+                ):
+                    yield item
+                    position = end
+                    continue
+        if finished:
+            raise ValueError("truncated json array")
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            chunk = text.decode(b"", final=True)
+        else:
+            chunk = text.decode(chunk)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+class SpillItems(ItemsView):
+    """items of a SpillMap, read from its store in batches"""
+
+    def __iter__(self):
+        yield from self._mapping.iter_items()
+
+
+class SpillMap(Mapping):
+    """
+    a dict (of json values, like arr_data's lists) that moves to a temporary
+    on-disk sqlite database once it holds more than limit entries. lookups
+    are then indexed queries and iterating reads the entries in batches
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = {}
+        self.connection = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __setitem__(self, key, value):
+        if self.connection is None:
+            self.data[key] = value
+            if len(self.data) > self.limit:
+                self.spill()
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?)", (key, json.dumps(value))
+            )
+            self.size = None
+
+    def spill(self):
+        """moves the entries to disk"""
+        connection = temporary_database()
+        connection.execute("CREATE TABLE entries (key PRIMARY KEY, value TEXT)")
+        connection.executemany(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?)",
+            ((key, json.dumps(value)) for key, value in self.data.items()),
+        )
+        self.connection = connection
+        self.size = None
+        self.data = {}
+
+    @property
+    def spilled(self):
+        """whether the entries are on disk"""
+        return self.connection is not None
+
+    def __getitem__(self, key):
+        if self.connection is None:
+            return self.data[key]
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        if self.connection is None:
+            return key in self.data
+        with self.lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                is not None
+            )
+
+    def __len__(self):
+        if self.connection is None:
+            return len(self.data)
+        with self.lock:
+            if self.size is None:
+                self.size = self.connection.execute(
+                    "SELECT COUNT(*) FROM entries"
+                ).fetchone()[0]
+            return self.size
+
+    def batches(self, query):
+        """runs a query over the store, yielding its rows a batch at a time"""
+        with self.lock:
+            cursor = self.connection.execute(query)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            yield from rows
+
+    def __iter__(self):
+        if self.connection is None:
+            yield from self.data
+            return
+        for (key,) in self.batches("SELECT key FROM entries"):
+            yield key
+
+    def iter_items(self):
+        """(key, value) pairs without a lookup per key"""
+        if self.connection is None:
+            yield from self.data.items()
+            return
+        for key, value in self.batches("SELECT key, value FROM entries"):
+            yield key, json.loads(value)
+
+    def items(self):
+        return SpillItems(self)
+
+    def close(self):
+        """drops the entries (and their temporary database)"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.data = {}
+
+
+def sql_diff(arr_ids, arr_trakt_ids, listed_trakt_ids, listed_tags, wipe, remove):
+    """
+    parallel.diff_ids (same arguments and results) run as indexed queries
+    on a temporary on-disk database, instead of building a dict and set of
+    every listed/wanted id in memory
+    """
+    connection = temporary_database()
+    try:
+        connection.execute(
+            "CREATE TABLE arr (position INTEGER PRIMARY KEY, arr_id INTEGER, trakt_id INTEGER)"
+        )
+        connection.execute(
+            "CREATE TABLE listed (position INTEGER PRIMARY KEY, trakt_id INTEGER, tag INTEGER)"
+        )
+        connection.executemany(
+            "INSERT INTO arr VALUES (?, ?, ?)",
+            (
+                (position, arr_id, trakt_id)
+                for position, (arr_id, trakt_id) in enumerate(
+                    zip(arr_ids, arr_trakt_ids)
+                )
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO listed VALUES (?, ?, ?)",
+            (
+                (position, trakt_id, tag)
+                for position, (trakt_id, tag) in enumerate(
+                    zip(listed_trakt_ids, listed_tags)
+                )
+            ),
+        )
+        # a trakt id listed twice counts as its last position (like diff_ids's dict)
+        connection.execute(
+            "CREATE TABLE last AS SELECT trakt_id, MAX(position) AS position "
+            "FROM listed GROUP BY trakt_id"
+        )
+        connection.execute("CREATE INDEX last_trakt ON last (trakt_id)")
+        connection.execute("CREATE INDEX arr_trakt ON arr (trakt_id)")
+
+        needed_ids = array("q")
+        corrections = array("q")
+        extra = array("q")
+        if wipe:
+            needed_ids.extend(arr_ids)
+        else:
+            needed_ids.extend(
+                arr_id
+                for (arr_id,) in connection.execute(
+                    "SELECT a.arr_id FROM arr a LEFT JOIN last l "
+                    "ON a.trakt_id != 0 AND l.trakt_id = a.trakt_id "
+                    "WHERE l.trakt_id IS NULL ORDER BY a.position"
+                )
+            )
+            for arr_position, listed_position in connection.execute(
+                "SELECT a.position, l.position FROM arr a "
+                "JOIN last l ON a.trakt_id != 0 AND l.trakt_id = a.trakt_id "
+                "JOIN listed t ON t.position = l.position "
+                "WHERE t.tag != a.arr_id ORDER BY a.position"
+            ):
+                corrections.extend((arr_position, listed_position))
+        if remove:
+            wanted = "" if wipe else "WHERE trakt_id NOT IN (SELECT trakt_id FROM arr)"
+            extra.extend(
+                position
+                for (position,) in connection.execute(
+                    f"SELECT position FROM last {wanted} ORDER BY position"
+                )
+            )
+        return needed_ids, extra, corrections
+    finally:
+        connection.close()
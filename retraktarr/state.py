@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+""" on-disk state that needs to survive between runs (journals, caches) """
+import json
+import os
+import re
+from os import path
+
+
+class StateStore:
+    """small json file store kept in the retraktarr state directory"""
+
+    def __init__(self, state_dir=None):
+        if state_dir is None:
+            state_dir = path.join(
+                os.environ.get(
+                    "XDG_STATE_HOME", path.join(path.expanduser("~"), ".local", "state")
+                ),
+                "retraktarr",
+            )
+        self.state_dir = state_dir
+
+    @staticmethod
+    def key(*parts):
+        """builds a filesystem safe state name from its parts (user, list, etc)"""
+        return "_".join(
+            re.sub(r"[^a-z0-9-]+", "-", str(part).lower()).strip("-") for part in parts
+        )
+
+    def path(self, name):
+        """returns the file path of a state entry"""
+        return path.join(self.state_dir, f"{name}.json")
+
+    def lock_path(self, name):
+        """returns the file path of a lock kept with the state"""
+        return path.join(self.state_dir, f"{name}.lock")
+
+    def load(self, name, default=None):
+        """loads a state entry, returns default if it's missing or unreadable"""
+        try:
+            with open(self.path(name), encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return default
+
+    def save(self, name, data):
+        """atomically writes a state entry (a crash never leaves half a file)"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = f"{self.path(name)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as state_file:
+            json.dump(data, state_file, separators=(",", ":"))
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmp_path, self.path(name))
+
+    def delete(self, name):
+        """removes a state entry if it exists"""
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" per request timeouts, worked out from each host's observed response times """
+import threading
+from urllib.parse import urlparse
+
+
+class TimeoutModel:
+    """
+    running estimates (exponentially weighted, kept between runs) of how
+    long each host takes to start answering a request - a fixed part plus a
+    part per item the request lists/sends - and how fast it sends bodies.
+    requests get a (connect, read) timeout of `margin` times what's expected,
+    so a stalled connection fails fast while big transfers get the time they need
+    """
+
+    # (floor, ceiling) in seconds
+    CONNECT = (3.05, 15)
+    READ = (5, 600)
+
+    def __init__(self, store=None, alpha=0.3, margin=4):
+        # without a store the estimates only last for the run
+        self.store = store
+        self.name = "timeouts"
+        self.alpha = alpha
+        self.margin = margin
+        # "METHOD host" -> {"connect", "base", "per_item", "bytes_per_second"}
+        self.hosts = {}
+        # "host/path" -> items it returned last time
+        self.items = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """loads the estimates of earlier runs"""
+        if self.store is not None:
+            data = self.store.load(self.name, {})
+            self.hosts = data.get("hosts", {})
+            self.items = data.get("items", {})
+        return self
+
+    def save(self):
+        """writes the estimates back if anything was learned"""
+        with self.lock:
+            if self.store is None or not self.changed:
+                return
+            self.store.save(self.name, {"hosts": self.hosts, "items": self.items})
+            self.changed = False
+
+    @staticmethod
+    def kind(method, url, label=None):
+        """
+        the key a request's estimates are kept under, label sets apart
+        requests to the same host that cost very differently (arr imports)
+        """
+        kind = f"{method} {urlparse(url).netloc.split('@')[-1]}"
+        return kind if label is None else f"{kind} {label}"
+
+    def host(self, kind):
+        """the estimates for a kind of request, defaults until it's been seen"""
+        return self.hosts.get(
+            kind,
+            {"connect": 0.5, "base": 1.0, "per_item": 0.01, "bytes_per_second": 2e5},
+        )
+
+    def timeout(self, kind, items=0, size=0, cold=None):
+        """
+        (connect, read) timeout for a request listing/sending `items` items
+        and uploading `size` bytes. until a kind of request has been seen
+        its read timeout is at least `cold` (the old fixed timeout)
+        """
+        with self.lock:
+            seen = kind in self.hosts
+            host = self.host(kind)
+        expected = (
+            host["base"] + host["per_item"] * items + size / host["bytes_per_second"]
+        )
+        read = min(max(self.margin * expected, self.READ[0]), self.READ[1])
+        if not seen and cold is not None:
+            read = max(read, cold)
+        return (
+            min(max(self.margin * host["connect"], self.CONNECT[0]), self.CONNECT[1]),
+            read,
+        )
+
+    def observe(self, kind, items, response, seconds, size=0, received=None):
+        """
+        updates the estimates with a finished request: `seconds` from sending
+        to the end of the body, response.elapsed is when its headers came in
+        (received is the body's size, for streamed responses not read yet)
+        """
+        elapsed = getattr(response, "elapsed", None)
+        first_byte = elapsed.total_seconds() if elapsed is not None else seconds
+        if received is None:
+            received = len(response.content or b"")
+        with self.lock:
+            host = dict(self.host(kind))
+            waited = max(first_byte - size / host["bytes_per_second"], 0)
+            if items == 0:
+                # small requests are mostly the round trip
+                host["connect"] += self.alpha * (waited - host["connect"])
+                host["base"] += self.alpha * (waited - host["base"])
+            else:
+                host["per_item"] += self.alpha * (
+                    max(waited - host["base"], 0) / items - host["per_item"]
+                )
+            if received >= 1 << 16 and seconds - first_byte > 0:
+                host["bytes_per_second"] += self.alpha * (
+                    received / (seconds - first_byte) - host["bytes_per_second"]
+                )
+            self.hosts[kind] = host
+            self.changed = True
+
+    def stalled(self, kind, read):
+        """a request ran out its `read` timeout, give the retry twice as long"""
+        with self.lock:
+            host = dict(self.host(kind))
+            host["base"] = max(host["base"], 2 * read / self.margin)
+            self.hosts[kind] = host
+            self.changed = True
+
+    def expected_items(self, url):
+        """items a url returned last time (0 if it hasn't been fetched yet)"""
+        with self.lock:
+            return self.items.get(self.item_key(url), 0)
+
+    def set_items(self, url, count):
+        """remembers how many items a url returned"""
+        with self.lock:
+            if self.items.get(self.item_key(url)) != count:
+                self.items[self.item_key(url)] = count
+                self.changed = True
+
+    @staticmethod
+    def item_key(url):
+        parsed_url = urlparse(url)
+        return f"{parsed_url.netloc.split('@')[-1]}{parsed_url.path}"